@@ -4,16 +4,24 @@ import argparse
 import math
 import os
 import logging
-from torch.utils.data import random_split
+import signal
+import sys
+import time
 
-from dataloader import get_cifar10, get_cifar100
+from dataloader import get_cifar10, get_cifar100, InfiniteDataLoader, Prefetcher, TensorEvalLoader, val_test_split, worker_memory, num_expanded_labels
 from test import test_cifar10, test_cifar100
-from utils import accuracy
-from test import test_cifar10, test_cifar100, load_checkpoint, save_checkpoint,  find_model_accuracy
+from utils import accuracy, StageTimer, MetricAccumulator, build_profiler
+from test import test_cifar10, test_cifar100, load_checkpoint, save_checkpoint, CheckpointWriter, find_model_accuracy, \
+    rng_state, set_rng_state, restore_initial_rng, load_resume_state, mark_completed, PreemptionHandler
 
 from model.wrn import WideResNet
+from pseudo_label import PseudoLabelBuffer
+from ensemble import StackedWideResNet
 
+import numpy as np
 import torch
+import torch.multiprocessing as mp
+from torch.profiler import record_function
 import torch.optim as optim
 import torch.nn as nn
 from torch.utils.data import DataLoader
@@ -24,6 +32,11 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(
 
 
 def main(args):
+    restore_initial_rng(os.path.join(args.dataout, 'resume.task1.rng.pt'), args.resume)
+    if args.synthetic:
+        # Generated CIFAR-format data of its own root, read through the cache
+        args.datapath = os.path.join(args.datapath, 'synthetic-{}'.format(args.synthetic))
+        args.data_cache = True
     if args.dataset == "cifar10":
         args.num_classes = 10
         labeled_dataset, unlabeled_dataset, test_dataset = get_cifar10(args,
@@ -34,33 +47,13 @@ def main(args):
                                                                         args.datapath)
     args.epoch = math.ceil(args.total_iter / args.iter_per_epoch)
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
     val_size = 1000
-    test_size = len(test_dataset) - val_size
-    test_dataset, val_dataset = random_split(test_dataset, [test_size, val_size])
-
-    labeled_loader = iter(DataLoader(labeled_dataset,
-                                     batch_size=args.train_batch,
-                                     shuffle=True,
-                                     num_workers=args.num_workers))
-    unlabeled_loader = iter(DataLoader(unlabeled_dataset,
-                                       batch_size=args.train_batch,
-                                       shuffle=True,
-                                       num_workers=args.num_workers))
-    test_loader = DataLoader(test_dataset,
-                             batch_size=args.test_batch,
-                             shuffle=False,
-                             num_workers=args.num_workers)
-                    
-    val_loader = DataLoader(val_dataset,
-                             batch_size=args.test_batch,
-                             shuffle=False,
-                             num_workers=args.num_workers)
+    test_dataset, val_dataset = val_test_split(args, args.datapath, test_dataset, val_size)
 
     model = WideResNet(args.model_depth,
                        args.num_classes, widen_factor=args.model_width, dropRate=0.25)
-    model = model.to(device)
+    # Every threshold starts from the same weights, kept in memory
+    init_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
 
     ############################################################################
     # TODO: SUPPLY your code
@@ -69,11 +62,6 @@ def main(args):
     logging.info('%s; Num Labeled = %s; Epochs = %s; LR = %s; Momentum = %s; wd = %s',
                  args.dataset, args.num_labeled, args.epoch, args.lr, args.momentum, args.wd)
 
-    init_path = os.path.join(curr_path, 'init_model.pt')
-    torch.save(model.state_dict(), init_path)
-
-    criterion = nn.CrossEntropyLoss()
-
     # Code to evaluate the best model
 
     # path = os.path.join(curr_path,'best_model','cifar10-4000','best_model95.pt')
@@ -85,148 +73,599 @@ def main(args):
     
 
     threshold_list = [0.6, 0.75, 0.95]
+    datasets = (labeled_dataset, unlabeled_dataset, val_dataset, test_dataset)
+
+    if args.sweep == 'parallel':
+        run_parallel_sweep(args, threshold_list, init_state, datasets)
+    elif args.sweep == 'vmap':
+        train_ensemble(args, threshold_list, init_state, datasets)
+    else:
+        for threshold in threshold_list:
+            train_threshold(args, threshold, init_state, datasets)
+
+
+def run_parallel_sweep(args, threshold_list, init_state, datasets):
+    '''
+    Trains every threshold at the same time in its own process. The CPUs
+    available to this process are split into one disjoint set per threshold;
+    each process is pinned to its set and uses as many intra-op threads as
+    it has CPUs. With fewer CPUs than thresholds the CPUs are handed out
+    round-robin, so every process gets one CPU and some of them share it.
+    The initial weights are moved to shared memory and handed to the
+    processes without going through a file.
+    '''
+    for tensor in init_state.values():
+        tensor.share_memory_()
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+        else list(range(os.cpu_count()))
+    if len(cpus) < len(threshold_list):
+        cpu_sets = [[cpus[i % len(cpus)]] for i in range(len(threshold_list))]
+    else:
+        cpu_sets = [[int(c) for c in chunk]
+                    for chunk in np.array_split(cpus, len(threshold_list))]
+    logging.info('Running thresholds %s in parallel on CPU sets %s',
+                 threshold_list, cpu_sets)
+    context = mp.spawn(sweep_worker,
+                       args=(args, threshold_list, cpu_sets, init_state, datasets),
+                       nprocs=len(threshold_list), join=False)
+
+    # The batch system only signals this process, every worker writes its
+    # own resumable checkpoint before it exits
+    def forward_preemption(signum, frame):
+        for process in context.processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+    signal.signal(signal.SIGTERM, forward_preemption)
+    try:
+        while not context.join():
+            pass
+    except mp.ProcessExitedException as e:
+        if e.exit_code == 128 + signal.SIGTERM:
+            sys.exit(e.exit_code)
+        raise
+
+
+def sweep_worker(rank, args, threshold_list, cpu_sets, init_state, datasets):
+    threshold = threshold_list[rank]
+    cpu_set = cpu_sets[rank]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_set)
+    torch.set_num_threads(len(cpu_set))
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(message)s',
+                        datefmt='%a, %d %b %Y %H:%M:%S', force=True,
+                        filename=os.path.join(curr_path, 'out.task1.' + str(int(threshold*100)) + '.log'))
+    train_threshold(args, threshold, init_state, datasets)
+
+
+def train_threshold(args, threshold, init_state, datasets):
+    labeled_dataset, unlabeled_dataset, val_dataset, test_dataset = datasets
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    for threshold in threshold_list:
-        model.load_state_dict(torch.load(init_path))
-        optimizer = optim.SGD(params=model.parameters(), lr=args.lr,
-                              momentum=args.momentum, weight_decay=args.wd)
-        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
-            optimizer, factor=0.2, patience=7)
-        best_loss = float('inf')
-        best_path = os.path.join(
-            curr_path, 'best_model' + str(int(threshold*100)) + '.pt')
-        logging.info('Model Parameters for threshold %s',
-                     threshold)
-        loss_list = []
-        for epoch in range(args.epoch):
-            model.train()
-            x_pseudo_set = []
-            y_pseudo_set = []
-            correct = 0
-            total = 0
-            running_loss = 0.0
-
-            for i in range(args.iter_per_epoch):
-                try:
-                    # labeled data
-                    x_l, y_l = next(labeled_loader)
-                except StopIteration:
-                    labeled_loader = iter(DataLoader(labeled_dataset,
-                                                     batch_size=args.train_batch,
-                                                     shuffle=True,
-                                                     num_workers=args.num_workers))
-                    x_l, y_l = next(labeled_loader)
-
-                try:
-                    # unlabeled data
-                    x_ul, _ = next(unlabeled_loader)
-                except StopIteration:
-                    unlabeled_loader = iter(DataLoader(unlabeled_dataset,
-                                                       batch_size=args.train_batch,
-                                                       shuffle=True,
-                                                       num_workers=args.num_workers))
-                    x_ul, _ = next(unlabeled_loader)
-
-                x_l, y_l = x_l.to(device), y_l.to(device)
-                x_ul = x_ul.to(device)
-                ####################################################################
-                # TODO: SUPPLY your code
-                ####################################################################
-
-                # concatenate labeled and unlabeled
-                if x_pseudo_set:
-                    x_pseudo_tensor = torch.stack(x_pseudo_set).to(device)
-                    x_l = torch.cat((x_l, x_pseudo_tensor))
-                    y_l = torch.cat(
-                        (y_l, torch.tensor(y_pseudo_set).to(device)))
-
-                # train model
-                y_pred_l = model(x_l)
-
-                # compute loss
-                correct += (torch.argmax(y_pred_l, axis=1)
-                            == y_l).float().sum()
-                total += float(x_l.size(dim=0))
-
-                loss = criterion(y_pred_l, y_l)
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                running_loss += loss.item()
+    resume_path = os.path.join(
+        args.dataout, 'resume.task1.' + str(int(threshold*100)) + '.pt')
+    resume = load_resume_state(resume_path, args.resume)
+    if resume is not None and resume.get('completed') == 'test':
+        logging.info('Nothing to resume, threshold %s is complete', threshold)
+        return
+
+    labeled_loader = InfiniteDataLoader(labeled_dataset,
+                                        batch_size=args.train_batch,
+                                        num_workers=args.num_workers,
+                                        num_samples=num_expanded_labels(args),
+                                        pin_memory=device.type == 'cuda')
+    unlabeled_loader = InfiniteDataLoader(unlabeled_dataset,
+                                          batch_size=args.train_batch,
+                                          num_workers=args.num_workers,
+                                          pin_memory=device.type == 'cuda')
+    test_loader = DataLoader(test_dataset,
+                             batch_size=args.test_batch,
+                             shuffle=False,
+                             num_workers=args.num_workers,
+                             pin_memory=device.type == 'cuda')
 
-                # predict unlabeled
+    val_loader = DataLoader(val_dataset,
+                             batch_size=args.test_batch,
+                             shuffle=False,
+                             num_workers=args.num_workers,
+                             pin_memory=device.type == 'cuda')
+
+    # Stage the batches on the device ahead of the loop
+    labeled_loader, unlabeled_loader, test_loader, val_loader = [
+        Prefetcher(loader, device, args.prefetch, time_copies=args.timing) for loader in
+        (labeled_loader, unlabeled_loader, test_loader, val_loader)]
+
+    if args.eval_data == 'memory':
+        # The validation and test images are decoded and normalized once
+        test_loader, val_loader = [
+            TensorEvalLoader(dataset, args.test_batch, device,
+                             dtype=getattr(torch, args.eval_dtype),
+                             channels_last=args.eval_channels_last,
+                             num_workers=args.num_workers)
+            for dataset in (test_dataset, val_dataset)]
+
+    model = WideResNet(args.model_depth,
+                       args.num_classes, widen_factor=args.model_width, dropRate=0.25)
+    model.load_state_dict(init_state)
+    model = model.to(device)
+
+    criterion = nn.CrossEntropyLoss()
+
+    optimizer = optim.SGD(params=model.parameters(), lr=args.lr,
+                          momentum=args.momentum, weight_decay=args.wd)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+        optimizer, factor=0.2, patience=7)
+    best_loss = float('inf')
+    best_path = os.path.join(
+        curr_path, 'best_model' + str(int(threshold*100)) + '.pt')
+    checkpoint_writer = CheckpointWriter()
+    logging.info('Model Parameters for threshold %s',
+                 threshold)
+    loss_list = []
+    pseudo_buffer = PseudoLabelBuffer(args.train_batch,
+                                      unlabeled=args.pseudo_forward == 'fused')
+    train_metrics = MetricAccumulator(args.num_classes, device)
+    val_metrics = MetricAccumulator(args.num_classes, device)
+
+    preemption = PreemptionHandler()
+
+    def resume_state(epoch, iteration):
+        return {
+            'epoch': epoch,
+            'iteration': iteration,
+            'threshold': threshold,
+            'state_dict': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'labeled_loader': labeled_loader.state_dict(),
+            'unlabeled_loader': unlabeled_loader.state_dict(),
+            'pseudo_buffer': pseudo_buffer.state_dict(),
+            'rng': rng_state(),
+            'best_loss': best_loss,
+            'loss_list': loss_list,
+            'train_metrics': train_metrics.state_dict(),
+            'num_images': num_images,
+        }
+
+    start_epoch = 0
+    if resume is not None and resume.get('completed') == 'train':
+        # Only the evaluation of the best model is left
+        resume, start_epoch = None, args.epoch
+    if resume is not None:
+        model.load_state_dict(resume['state_dict'])
+        optimizer.load_state_dict(resume['optimizer'])
+        scheduler.load_state_dict(resume['scheduler'])
+        labeled_loader.load_state_dict(resume['labeled_loader'])
+        unlabeled_loader.load_state_dict(resume['unlabeled_loader'])
+        pseudo_buffer.load_state_dict(resume['pseudo_buffer'], device)
+        set_rng_state(resume['rng'])
+        best_loss, loss_list = resume['best_loss'], resume['loss_list']
+        start_epoch = resume['epoch']
+
+    timer = StageTimer(args.timing, os.path.join(
+        curr_path, 'out.task1.' + str(int(threshold*100)) + '.timing.jsonl'),
+        sync_cuda=args.timing and device.type == 'cuda')
+    profiler = build_profiler(args, 'task1.' + str(int(threshold*100)))
+    profiler.start()
+    for epoch in range(start_epoch, args.epoch):
+        model.train()
+        train_metrics.reset()
+        num_images = 0
+        epoch_start = time.perf_counter()
+        first_iter = 0
+        if resume is not None:
+            # Continue the interrupted epoch with its pseudo-labels
+            first_iter = resume['iteration']
+            train_metrics.load_state_dict(resume['train_metrics'])
+            num_images = resume['num_images']
+            resume = None
+        else:
+            pseudo_buffer.clear()
+
+        for i in range(first_iter, args.iter_per_epoch):
+            timer.mark()
+            # labeled data
+            x_l, y_l = next(labeled_loader)
+
+            # unlabeled data
+            x_ul, _ = next(unlabeled_loader)
+            timer.lap('data_wait')
+            timer.add('h2d_copy', labeled_loader.copy_time + unlabeled_loader.copy_time)
+            ####################################################################
+            # TODO: SUPPLY your code
+            ####################################################################
+
+            # labeled and pseudo-labeled rows, followed by the unlabeled rows
+            # for the fused forward, as one slice of the preallocated buffer
+            if args.pseudo_forward == 'fused':
+                # one forward over labeled and unlabeled, the unlabeled
+                # logits only pick the pseudo-labels
+                x, y_l = pseudo_buffer.batch(x_l, y_l, x_ul)
+                y_pred = model(x)
+                y_pred_l, y_pseudo_pred = torch.split(
+                    y_pred, [y_l.shape[0], x_ul.shape[0]])
+            else:
+                x, y_l = pseudo_buffer.batch(x_l, y_l)
+                y_pred_l = model(x)
+            num_images += y_l.shape[0] + x_ul.shape[0]
+
+            # compute loss
+            loss = criterion(y_pred_l, y_l)
+            train_metrics.update(y_pred_l, y_l, loss)
+            timer.lap('forward')
+            optimizer.zero_grad()
+            loss.backward()
+            timer.lap('backward')
+            optimizer.step()
+            timer.lap('optimizer')
+
+            # predict unlabeled
+            if args.pseudo_forward == 'no-grad':
+                with torch.no_grad():
+                    y_pseudo_pred = model(x_ul)
+            elif args.pseudo_forward == 'separate':
                 y_pseudo_pred = model(x_ul)
 
-                # add to subset if probability is greater than threshold
-                y_pseudo_label_prob, y_pseudo_label_class = torch.max(
-                    y_pseudo_pred, axis=1)
+            # add to subset if probability is greater than threshold
+            pseudo_buffer.update(x_ul, y_pseudo_pred, threshold)
+            timer.lap('pseudo_label')
+            timer.count(y_l.shape[0] + x_ul.shape[0])
+            profiler.step()
+
+            if preemption.requested:
+                checkpoint_writer.save(resume_state(epoch, i + 1), resume_path)
+                checkpoint_writer.close()
+                preemption.exit()
+            if args.checkpoint_every and (epoch * args.iter_per_epoch + i + 1) % args.checkpoint_every == 0:
+                checkpoint_writer.save(resume_state(epoch, i + 1), resume_path)
+            # End of batch
+
+        train_result = train_metrics.compute()
+        train_accuracy, running_loss = train_result['top1'], train_result['loss']
+        loss_list.append(running_loss)
+        logging.info('Epoch %s/%s, Throughput: %.1f images/s (%s pseudo-label forward)',
+                     epoch+1, args.epoch,
+                     num_images / (time.perf_counter() - epoch_start),
+                     args.pseudo_forward)
+        logging.info('Epoch %s/%s, Data wait: %.2f ms/iteration',
+                     epoch+1, args.epoch,
+                     1000 * (labeled_loader.reset_wait_time()
+                             + unlabeled_loader.reset_wait_time()) / args.iter_per_epoch)
+
+        timer.mark()
+        with torch.no_grad():
+            model.eval()
+            val_metrics.reset()
+            for x_v, y_v in val_loader:
+                y_op_val = model(x_v)
+                val_metrics.update(y_op_val, y_v, criterion(y_op_val, y_v))
+
+            val_result = val_metrics.compute()
+            test_accuracy, test_loss = val_result['top1'], val_result['loss']
+            timer.lap('validation')
+
+            logging.info("Epoch %s/%s, Train Accuracy: %.3f, Test Accuracy: %.3f, Training Loss: %.3f, Test Loss: %.3f",
+                         epoch+1,
+                         args.epoch,
+                         train_accuracy,
+                         test_accuracy,
+                         running_loss,
+                         test_loss
+                         )
+
+            if test_loss < best_loss:
+                best_loss = test_loss
+                checkpoint = {
+                    'epoch': epoch+1,
+                    'threshold': threshold,
+                    'validation_loss': test_loss,
+                    'validation_accuracy': test_accuracy,
+                    'state_dict': model.state_dict(),
+                }
+                save_checkpoint(checkpoint, best_path, checkpoint_writer)
+        timer.log(epoch+1)
+        if args.report_memory:
+            for usage in worker_memory():
+                logging.info('Worker %s: RSS = %.1f MB, anonymous = %.1f MB, shared = %.1f MB',
+                             usage['pid'], usage['rss'], usage['anon'], usage['shared'])
+
+        scheduler.step(test_loss)
+        print("Epoch {}/{}, Train Accuracy: {:.3f}, Test Accuracy: {:.3f}, Training Loss: {:.3f}, Test Loss: {:.3f}".format(
+            epoch+1,
+            args.epoch,
+            train_accuracy,
+            test_accuracy,
+            running_loss,
+            test_loss
+        ))
+
+    profiler.stop()
+    # The best checkpoint has to be on disk before it is evaluated
+    checkpoint_writer.close()
+    mark_completed(resume_path, 'train')
+    logging.info('Training Complete...')
+
+    # Model Evaluation
+    logging.info('Evalutating Model for Threshold = %s', threshold)
+    if args.dataset == "cifar10":
+        test_cifar10(args, device, test_loader, best_path)
+    elif args.dataset == "cifar100":
+        test_cifar100(args, device, test_loader, best_path)
+    mark_completed(resume_path, 'test')
+
+
+
+def train_ensemble(args, threshold_list, init_state, datasets):
+    '''
+    Trains one model per threshold as a single vectorized StackedWideResNet
+    that shares one labeled and one unlabeled data stream. The pseudo-labels
+    of every copy are the full unlabeled batch of the previous iteration
+    with a per-copy mask; masked rows are left out of the loss and the
+    accuracy but, unlike in the sequential sweep, they still take part in
+    the BatchNorm batch statistics. Every threshold gets its own best
+    checkpoint in the format save_checkpoint writes.
+    '''
+    labeled_dataset, unlabeled_dataset, val_dataset, test_dataset = datasets
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-                x_pseudo_set = []
-                y_pseudo_set = []
-                for k, row in enumerate(y_pseudo_label_prob):
-                    if row >= threshold:
-                        x_pseudo_set.append(x_ul[k, :, :, :])
-                        y_pseudo_set.append(y_pseudo_label_class[k])
-                # End of batch
+    resume_path = os.path.join(args.dataout, 'resume.task1.vmap.pt')
+    resume = load_resume_state(resume_path, args.resume)
+    if resume is not None and resume.get('completed') == 'test':
+        logging.info('Nothing to resume, thresholds %s are complete', threshold_list)
+        return
+    start_epoch = 0
+    if resume is not None and resume.get('completed') == 'train':
+        # Only the evaluation of the best models is left
+        resume, start_epoch = None, args.epoch
+
+    labeled_loader = InfiniteDataLoader(labeled_dataset,
+                                        batch_size=args.train_batch,
+                                        num_workers=args.num_workers,
+                                        num_samples=num_expanded_labels(args),
+                                        pin_memory=device.type == 'cuda')
+    unlabeled_loader = InfiniteDataLoader(unlabeled_dataset,
+                                          batch_size=args.train_batch,
+                                          num_workers=args.num_workers,
+                                          pin_memory=device.type == 'cuda')
+    test_loader = DataLoader(test_dataset,
+                             batch_size=args.test_batch,
+                             shuffle=False,
+                             num_workers=args.num_workers,
+                             pin_memory=device.type == 'cuda')
 
-            train_accuracy = 100 * correct / total
-            running_loss /= args.iter_per_epoch
-            loss_list.append(running_loss)
+    val_loader = DataLoader(val_dataset,
+                             batch_size=args.test_batch,
+                             shuffle=False,
+                             num_workers=args.num_workers,
+                             pin_memory=device.type == 'cuda')
+
+    # Stage the batches on the device ahead of the loop
+    labeled_loader, unlabeled_loader, test_loader, val_loader = [
+        Prefetcher(loader, device, args.prefetch, time_copies=args.timing) for loader in
+        (labeled_loader, unlabeled_loader, test_loader, val_loader)]
+
+    if args.eval_data == 'memory':
+        # The validation and test images are decoded and normalized once
+        test_loader, val_loader = [
+            TensorEvalLoader(dataset, args.test_batch, device,
+                             dtype=getattr(torch, args.eval_dtype),
+                             channels_last=args.eval_channels_last,
+                             num_workers=args.num_workers)
+            for dataset in (test_dataset, val_dataset)]
+
+    preemption = PreemptionHandler()
+
+    models = []
+    for k, _ in enumerate(threshold_list):
+        model = WideResNet(args.model_depth,
+                           args.num_classes, widen_factor=args.model_width, dropRate=0.25)
+        # the weights are stacked when the ensemble is built
+        model.load_state_dict(resume['state_dicts'][k] if resume is not None else init_state)
+        models.append(model.to(device))
+    ensemble = StackedWideResNet(models)
+    num_models = len(ensemble)
+    thresholds = torch.tensor(threshold_list, device=device).view(-1, 1)
+
+    optimizers = [optim.SGD(params=model.parameters(), lr=args.lr,
+                            momentum=args.momentum, weight_decay=args.wd)
+                  for model in models]
+    schedulers = [torch.optim.lr_scheduler.ReduceLROnPlateau(
+        optimizer, factor=0.2, patience=7) for optimizer in optimizers]
+    criterion = nn.CrossEntropyLoss()
+    val_metrics = [MetricAccumulator(args.num_classes, device) for _ in threshold_list]
+    best_loss = [float('inf')] * num_models
+    best_paths = [os.path.join(curr_path, 'best_model' + str(int(threshold*100)) + '.pt')
+                  for threshold in threshold_list]
+    checkpoint_writer = CheckpointWriter(max_pending=num_models + 1)
+    logging.info('Model Parameters for thresholds %s (vectorized)', threshold_list)
+    timer = StageTimer(args.timing, os.path.join(curr_path, 'out.task1.vmap.timing.jsonl'),
+                       sync_cuda=args.timing and device.type == 'cuda')
+
+
+    def resume_state(epoch, iteration):
+        return {
+            'epoch': epoch,
+            'iteration': iteration,
+            'thresholds': threshold_list,
+            'state_dicts': [ensemble.state_dict(k) for k in range(num_models)],
+            'optimizers': [optimizer.state_dict() for optimizer in optimizers],
+            'schedulers': [scheduler.state_dict() for scheduler in schedulers],
+            'labeled_loader': labeled_loader.state_dict(),
+            'unlabeled_loader': unlabeled_loader.state_dict(),
+            # the pseudo-labeled inputs are the same for every copy
+            'pseudo': (x_pseudo[0], y_pseudo, w_pseudo) if x_pseudo is not None else None,
+            'rng': rng_state(),
+            'best_loss': best_loss,
+            'correct': correct.tolist(),
+            'total': total.tolist(),
+            'running_loss': running_loss.tolist(),
+            'num_images': num_images,
+        }
+
+    if resume is not None:
+        for optimizer, state in zip(optimizers, resume['optimizers']):
+            optimizer.load_state_dict(state)
+        for scheduler, state in zip(schedulers, resume['schedulers']):
+            scheduler.load_state_dict(state)
+        labeled_loader.load_state_dict(resume['labeled_loader'])
+        unlabeled_loader.load_state_dict(resume['unlabeled_loader'])
+        set_rng_state(resume['rng'])
+        best_loss = resume['best_loss']
+        start_epoch = resume['epoch']
+
+    profiler = build_profiler(args, 'task1.vmap')
+    profiler.start()
+    for epoch in range(start_epoch, args.epoch):
+        ensemble.train()
+        x_pseudo = None
+        correct = torch.zeros(num_models, device=device)
+        total = torch.zeros(num_models, device=device)
+        running_loss = torch.zeros(num_models, device=device)
+        num_images = 0
+        epoch_start = time.perf_counter()
+        first_iter = 0
+        if resume is not None:
+            # Continue the interrupted epoch with its pseudo-labels
+            first_iter = resume['iteration']
+            if resume['pseudo'] is not None:
+                x_pseudo, y_pseudo, w_pseudo = [t.to(device) for t in resume['pseudo']]
+                x_pseudo = x_pseudo.expand(num_models, *x_pseudo.shape)
+            correct = torch.tensor(resume['correct'], device=device)
+            total = torch.tensor(resume['total'], device=device)
+            running_loss = torch.tensor(resume['running_loss'], device=device)
+            num_images = resume['num_images']
+            resume = None
+
+        for i in range(first_iter, args.iter_per_epoch):
+            timer.mark()
+            x_l, y_l = next(labeled_loader)
+            x_ul, _ = next(unlabeled_loader)
+            timer.lap('data_wait')
+            timer.add('h2d_copy', labeled_loader.copy_time + unlabeled_loader.copy_time)
+
+            # every copy trains on the labeled batch and on its own
+            # pseudo-labeled rows of the previous unlabeled batch
+            x = x_l.expand(num_models, *x_l.shape)
+            y = y_l.expand(num_models, *y_l.shape)
+            weight = torch.ones(y.shape, device=device)
+            if x_pseudo is not None:
+                x = torch.cat((x, x_pseudo), dim=1)
+                y = torch.cat((y, y_pseudo), dim=1)
+                weight = torch.cat((weight, w_pseudo), dim=1)
+
+            y_pred = ensemble(x)
+            num_images += x_l.shape[0] + x_ul.shape[0]
+
+            loss = nn.functional.cross_entropy(
+                y_pred.flatten(0, 1), y.flatten(), reduction='none').view(y.shape)
+            loss = (loss * weight).sum(dim=1) / weight.sum(dim=1)
+            timer.lap('forward')
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+            # the copies are independent, the sum gives every copy the
+            # gradient of its own loss
+            loss.sum().backward()
+            timer.lap('backward')
+            for optimizer in optimizers:
+                optimizer.step()
+            timer.lap('optimizer')
 
             with torch.no_grad():
-                model.eval()
-                test_loss = 0.0
-                correct = 0.0
-                for j, (x_v, y_v) in enumerate(val_loader):
-                    x_v, y_v = x_v.to(device), y_v.to(device)
-                    y_op_val = model(x_v)
-                    loss = criterion(y_op_val, y_v)
-
-                    test_loss += loss.item()
-                    _, y_pred_test = y_op_val.max(1)
-                    correct += y_pred_test.eq(y_v).sum()
-
-                test_accuracy = 100 * correct.float() / len(val_loader.dataset)
-                test_loss = test_loss / j
-
-                logging.info("Epoch %s/%s, Train Accuracy: %.3f, Test Accuracy: %.3f, Training Loss: %.3f, Test Loss: %.3f",
-                             epoch+1,
-                             args.epoch,
-                             train_accuracy.item(),
-                             test_accuracy,
-                             running_loss,
-                             test_loss
-                             )
-
-                if test_loss < best_loss:
-                    best_loss = test_loss
-                    checkpoint = {
-                        'epoch': epoch+1,
-                        'threshold': threshold,
-                        'validation_loss': test_loss,
-                        'validation_accuracy': test_accuracy,
-                        'state_dict': model.state_dict(),
-                    }
-                    save_checkpoint(checkpoint, best_path)
-            scheduler.step(test_loss)
-            print("Epoch {}/{}, Train Accuracy: {:.3f}, Test Accuracy: {:.3f}, Training Loss: {:.3f}, Test Loss: {:.3f}".format(
+                correct += ((torch.argmax(y_pred, dim=2) == y) * weight).sum(dim=1)
+                total += weight.sum(dim=1)
+                running_loss += loss
+
+                # predict unlabeled
+                y_pseudo_pred = ensemble(x_ul)
+            with record_function('pseudo_label_select'):
+                y_pseudo_prob, y_pseudo_class = torch.max(y_pseudo_pred, dim=2)
+                x_pseudo = x_ul.expand(num_models, *x_ul.shape)
+                y_pseudo = y_pseudo_class
+                w_pseudo = (y_pseudo_prob >= thresholds).float()
+            timer.lap('pseudo_label')
+            timer.count(x_l.shape[0] + x_ul.shape[0])
+            profiler.step()
+
+            if preemption.requested:
+                checkpoint_writer.save(resume_state(epoch, i + 1), resume_path)
+                checkpoint_writer.close()
+                preemption.exit()
+            if args.checkpoint_every and (epoch * args.iter_per_epoch + i + 1) % args.checkpoint_every == 0:
+                checkpoint_writer.save(resume_state(epoch, i + 1), resume_path)
+            # End of batch
+
+        train_accuracy = (100 * correct / total).tolist()
+        running_loss = (running_loss / args.iter_per_epoch).tolist()
+        logging.info('Epoch %s/%s, Throughput: %.1f images/s (vectorized, %s models)',
+                     epoch+1, args.epoch,
+                     num_images / (time.perf_counter() - epoch_start), num_models)
+        logging.info('Epoch %s/%s, Data wait: %.2f ms/iteration',
+                     epoch+1, args.epoch,
+                     1000 * (labeled_loader.reset_wait_time()
+                             + unlabeled_loader.reset_wait_time()) / args.iter_per_epoch)
+
+        timer.mark()
+        with torch.no_grad():
+            ensemble.eval()
+            # accounted per copy as in the sequential sweep, so both report
+            # the same validation loss
+            for metrics in val_metrics:
+                metrics.reset()
+            for x_v, y_v in val_loader:
+                y_op_val = ensemble(x_v)
+                for metrics, y_pred_v in zip(val_metrics, y_op_val):
+                    metrics.update(y_pred_v, y_v, criterion(y_pred_v, y_v))
+
+            val_results = [metrics.compute() for metrics in val_metrics]
+            test_accuracy = [result['top1'] for result in val_results]
+            test_loss = [result['loss'] for result in val_results]
+            timer.lap('validation')
+        timer.log(epoch+1)
+
+        for k, threshold in enumerate(threshold_list):
+            logging.info("Threshold %s, Epoch %s/%s, Train Accuracy: %.3f, Test Accuracy: %.3f, Training Loss: %.3f, Test Loss: %.3f",
+                         threshold,
+                         epoch+1,
+                         args.epoch,
+                         train_accuracy[k],
+                         test_accuracy[k],
+                         running_loss[k],
+                         test_loss[k]
+                         )
+            if test_loss[k] < best_loss[k]:
+                best_loss[k] = test_loss[k]
+                checkpoint = {
+                    'epoch': epoch+1,
+                    'threshold': threshold,
+                    'validation_loss': test_loss[k],
+                    'validation_accuracy': test_accuracy[k],
+                    'state_dict': ensemble.state_dict(k),
+                }
+                save_checkpoint(checkpoint, best_paths[k], checkpoint_writer)
+            schedulers[k].step(test_loss[k])
+            print("Threshold {}, Epoch {}/{}, Train Accuracy: {:.3f}, Test Accuracy: {:.3f}, Training Loss: {:.3f}, Test Loss: {:.3f}".format(
+                threshold,
                 epoch+1,
                 args.epoch,
-                train_accuracy.item(),
-                test_accuracy,
-                running_loss,
-                test_loss
+                train_accuracy[k],
+                test_accuracy[k],
+                running_loss[k],
+                test_loss[k]
             ))
 
-        logging.info('Training Complete...')
+    profiler.stop()
+    # The best checkpoint has to be on disk before it is evaluated
+    checkpoint_writer.close()
+    mark_completed(resume_path, 'train')
+    logging.info('Training Complete...')
 
-        # Model Evaluation
+    # Model Evaluation
+    for threshold, best_path in zip(threshold_list, best_paths):
         logging.info('Evalutating Model for Threshold = %s', threshold)
         if args.dataset == "cifar10":
             test_cifar10(args, device, test_loader, best_path)
         elif args.dataset == "cifar100":
             test_cifar100(args, device, test_loader, best_path)
-
+    mark_completed(resume_path, 'test')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Pseudo labeling \
@@ -237,6 +676,9 @@ if __name__ == "__main__":
     #                     type=str, choices=["cifar10", "cifar100"])
     parser.add_argument("--datapath", default="./data/",
                         type=str, help="Path to the CIFAR-10/100 dataset")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="seed of the labeled/unlabeled and validation/test splits, the splits "
+                             "are drawn once per seed and cached under <datapath>/splits")
     # parser.add_argument('--num-labeled', type=int,
     #                     default=2500, help='Total number of labeled samples')
     parser.add_argument('--num-labeled', type=int,
@@ -253,6 +695,28 @@ if __name__ == "__main__":
 #                       help="Weight decay")
     parser.add_argument("--expand-labels", action="store_true",
                         help="expand labels to fit eval steps")
+    parser.add_argument("--batch-augment", action="store_true",
+                        help="apply the weak augmentation to whole collated batches instead of per sample")
+    parser.add_argument("--synthetic", default=0, type=int,
+                        help="train on this many generated CIFAR-format images written to "
+                             "<datapath>/synthetic-N instead of the real dataset, needs no "
+                             "download (implies --data-cache)")
+    parser.add_argument("--data-cache", action="store_true",
+                        help="convert CIFAR once into .npy files under the datapath and memory-map them")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="move the dataset arrays to shared memory before the workers start")
+    parser.add_argument("--report-memory", action="store_true",
+                        help="log the resident memory of every DataLoader worker after each epoch")
+    parser.add_argument("--eval-data", default="loader", type=str, choices=["loader", "memory"],
+                        help="'memory' keeps the normalized validation and test images on the device "
+                             "and evaluates without DataLoader workers")
+    parser.add_argument("--eval-dtype", default="float32", type=str, choices=["float32", "float16"],
+                        help="storage type of the images with --eval-data memory")
+    parser.add_argument("--eval-channels-last", action="store_true",
+                        help="store the images channels_last with --eval-data memory")
+    parser.add_argument("--save-logits", action="store_true",
+                        help="write the test logits of the best model next to its checkpoint "
+                             "as a memory-mapped .npy file")
     parser.add_argument('--train-batch', default=64, type=int,
                         help='train batchsize')
     parser.add_argument('--test-batch', default=64, type=int,
@@ -261,10 +725,40 @@ if __name__ == "__main__":
                         help='total number of iterations to run')
     parser.add_argument('--iter-per-epoch', default=1024, type=int,
                         help="Number of iterations to run per epoch")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the resumable checkpoints in --dataout if there are any")
+    parser.add_argument("--checkpoint-every", default=200, type=int,
+                        help="iterations between resumable checkpoints (0 = only on SIGTERM)")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile a window of training iterations with torch.profiler, "
+                             "the Chrome trace, stacks and operator table are written to --dataout")
+    parser.add_argument("--profile-wait", default=5, type=int,
+                        help="iterations to skip before the profiler warms up")
+    parser.add_argument("--profile-warmup", default=2, type=int,
+                        help="profiler warm-up iterations, recorded but discarded")
+    parser.add_argument("--profile-active", default=5, type=int,
+                        help="iterations recorded by the profiler")
+    parser.add_argument("--profile-rows", default=30, type=int,
+                        help="rows of the operator table")
+    parser.add_argument("--timing", action="store_true",
+                        help="record per-stage timings of the training loop, logged per epoch and appended to out.task1*.timing.jsonl")
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help="Number of batches staged on the device ahead of the training loop (0 = synchronous)")
     parser.add_argument('--num-workers', default=1, type=int,
                         help="Number of workers to launch during training")
     parser.add_argument('--threshold', type=float, default=0.95,
                         help='Confidence Threshold for pseudo labeling')
+    parser.add_argument('--sweep', default='sequential', type=str,
+                        choices=['sequential', 'parallel', 'vmap'],
+                        help="Train the thresholds one after the other, all at once with one process "
+                             "per threshold on a disjoint set of CPUs, or all at once as a single "
+                             "vectorized model (torch.func) sharing one data stream")
+    parser.add_argument('--pseudo-forward', default='no-grad', type=str,
+                        choices=['no-grad', 'fused', 'separate'],
+                        help="How the unlabeled batch is scored: 'no-grad' runs a second forward "
+                             "without autograd after the step, 'fused' reuses the logits of one "
+                             "concatenated forward before the step (BatchNorm then sees both batches), "
+                             "'separate' is the original second forward with autograd enabled")
     parser.add_argument("--dataout", type=str, default="./path/to/output/",
                         help="Path to save log files")
     parser.add_argument("--model-depth", type=int, default=16,
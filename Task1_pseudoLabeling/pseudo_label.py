@@ -0,0 +1,88 @@
+import torch
+from torch.profiler import record_function
+
+
+class PseudoLabelBuffer:
+    '''
+    Fixed-capacity store for the pseudo-labeled samples that are added to the
+    next labeled batch. The training input lives in one preallocated buffer:
+    batch() writes the labeled rows right in front of the pseudo-labeled
+    rows, and optionally the unlabeled rows right behind them, so the model
+    input is a slice of the buffer and no tensor is concatenated or
+    allocated per iteration. The samples above the threshold are selected
+    with a mask and moved to the front of the pseudo-label rows by a stable
+    sort, so the selection stays on the device and needs no per-sample
+    Python work. count holds the number of valid rows; it is read back to
+    the host once per iteration, when batch() slices the buffer.
+
+    args:
+        capacity  : largest labeled and unlabeled batch
+        unlabeled : reserve rows for the unlabeled batch behind the
+                    pseudo-labels, for a single fused forward
+    '''
+    def __init__(self, capacity, unlabeled=False):
+        self.capacity = capacity
+        self.rows = capacity * (3 if unlabeled else 2)
+        self.x = None
+        self.y = None
+        self.count = None
+
+    def _allocate(self, x, device):
+        if self.x is None:
+            self.x = torch.empty((self.rows, *x.shape[1:]), dtype=x.dtype, device=device)
+            self.y = torch.empty(2 * self.capacity, dtype=torch.long, device=device)
+
+    def num_pseudo(self):
+        return 0 if self.count is None else int(self.count)
+
+    def update(self, x_ul, y_pred, threshold):
+        n = x_ul.shape[0]
+        assert n <= self.capacity
+        self._allocate(x_ul, x_ul.device)
+        end = self.capacity + n
+        with record_function('pseudo_label_select'):
+            y_prob, y_class = torch.max(y_pred.detach(), axis=1)
+            mask = y_prob >= threshold
+            # Selected rows first, in their original order
+            order = torch.argsort((~mask).to(torch.uint8), stable=True)
+            torch.index_select(x_ul, 0, order, out=self.x[self.capacity:end])
+            torch.index_select(y_class, 0, order, out=self.y[self.capacity:end])
+            self.count = mask.sum()
+
+    def clear(self):
+        self.count = None
+
+    def batch(self, x_l, y_l, x_ul=None):
+        '''
+        returns : (torch.Tensor, torch.Tensor) views of the buffer with the
+                    labeled and pseudo-labeled inputs, followed by x_ul if it
+                    is given, and the labels of the labeled and
+                    pseudo-labeled rows
+        '''
+        n = x_l.shape[0]
+        assert n <= self.capacity
+        self._allocate(x_l, x_l.device)
+        start, end = self.capacity - n, self.capacity + self.num_pseudo()
+        self.x[start:self.capacity].copy_(x_l)
+        self.y[start:self.capacity].copy_(y_l)
+        if x_ul is None:
+            return self.x[start:end], self.y[start:end]
+        self.x[end:end + x_ul.shape[0]].copy_(x_ul)
+        return self.x[start:end + x_ul.shape[0]], self.y[start:end]
+
+    def state_dict(self):
+        count = self.num_pseudo()
+        if count == 0:
+            return None
+        end = self.capacity + count
+        return {'x': self.x[self.capacity:end], 'y': self.y[self.capacity:end]}
+
+    def load_state_dict(self, state, device):
+        self.clear()
+        if state is None:
+            return
+        n = state['x'].shape[0]
+        self._allocate(state['x'], device)
+        self.x[self.capacity:self.capacity + n].copy_(state['x'])
+        self.y[self.capacity:self.capacity + n].copy_(state['y'])
+        self.count = torch.tensor(n, device=device)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import time
+import warnings
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model.wrn import WideResNet
+from vat import VATLoss, l2_norm
+
+
+class LegacyVATLoss(nn.Module):
+    '''
+    The previous VATLoss: backward() on every power iteration fills .grad of
+    all parameters and keeps the clean forward graph alive. Kept here only
+    as the baseline of this benchmark.
+    '''
+    def __init__(self, args):
+        super(LegacyVATLoss, self).__init__()
+        self.xi = args.vat_xi
+        self.eps = args.vat_eps
+        self.vat_iter = args.vat_iter
+
+    def forward(self, model, x):
+        r = l2_norm(torch.randn(x.shape).to(x.device))
+        pred = F.softmax(model(x), dim=1)
+        for num in range(self.vat_iter):
+            r.requires_grad_(True)
+            advPred = F.softmax(model(x + self.xi*r), dim=1)
+            adv_dist = F.kl_div(pred, advPred)
+            adv_dist.backward(retain_graph=True)
+            d = r.grad
+            model.zero_grad()
+        r_adv = l2_norm(d) * self.eps
+        adv_pred = F.softmax(model(x + r_adv), dim=1)
+        return F.kl_div(pred, adv_pred)
+
+
+def _read_status(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def benchmark(vat, model, x, device, steps, warmup):
+    '''
+    returns : (ms per step, peak memory above the starting point in MB) of
+              one VAT loss forward and backward. On the CPU the peak is the
+              growth of the process high-water mark (VmHWM), so every
+              configuration has to run in a fresh process.
+    '''
+    def step():
+        loss = vat(model, x)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated() / 2**20
+    else:
+        base = _read_status('VmRSS')
+    for _ in range(warmup):
+        step()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak = _read_status('VmHWM')
+    elapsed = (time.perf_counter() - start) / steps
+    return 1000 * elapsed, peak - base
+
+
+def run_config(impl, args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    model = WideResNet(args.model_depth, args.num_classes,
+                       widen_factor=args.model_width).to(device)
+    model.train()
+    x = torch.randn(args.train_batch, 3, 32, 32, device=device)
+    loss_cls = LegacyVATLoss if impl == 'legacy' else VATLoss
+    return benchmark(loss_cls(args), model, x, device, args.steps, args.warmup)
+
+
+def main(args):
+    warnings.filterwarnings('ignore', message='reduction: \'mean\'')
+    context = multiprocessing.get_context('spawn')
+    print('{:>8} {:>8} {:>12} {:>14}'.format('impl', 'vat_iter', 'ms/step', 'peak mem (MB)'))
+    for vat_iter in args.vat_iters:
+        args.vat_iter = vat_iter
+        for impl in ('legacy', 'grad'):
+            with context.Pool(1, initializer=warnings.filterwarnings,
+                              initargs=('ignore',)) as pool:
+                ms, mem = pool.apply(run_config, (impl, args))
+            print('{:>8} {:>8} {:>12.1f} {:>14.1f}'.format(impl, vat_iter, ms, mem))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-step cost and peak memory \
+                                        of VATLoss against the previous implementation")
+    parser.add_argument('--vat-iters', type=int, nargs='+', default=[1, 2, 4],
+                        help='Power iteration counts to benchmark')
+    parser.add_argument('--train-batch', default=64, type=int,
+                        help='unlabeled batchsize')
+    parser.add_argument('--num-classes', default=10, type=int,
+                        help='number of classes of the model')
+    parser.add_argument("--model-depth", type=int, default=28,
+                        help="model depth for wide resnet")
+    parser.add_argument("--model-width", type=int, default=2,
+                        help="model width for wide resnet")
+    parser.add_argument("--vat-xi", default=10.0, type=float,
+                        help="VAT xi parameter")
+    parser.add_argument("--vat-eps", default=1.0, type=float,
+                        help="VAT epsilon parameter")
+    parser.add_argument('--steps', default=10, type=int,
+                        help='timed steps per configuration')
+    parser.add_argument('--warmup', default=2, type=int,
+                        help='untimed steps before timing')
+
+    args = parser.parse_args()
+
+    main(args)
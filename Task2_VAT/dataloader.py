@@ -1,34 +1,540 @@
 import numpy as np
 import torch
 import math
+import os
+import threading
+import time
+from queue import Queue, Full
+import pickle
 
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
 from PIL import Image
+from torch.utils.data import DataLoader, Sampler, Subset
+from torch.utils.data.dataloader import default_collate
+from torchvision.datasets.utils import download_and_extract_archive
 
 cifar10_mean    = [0.4914, 0.4822, 0.4465]
 cifar10_std     = [0.2471, 0.2435, 0.2616]
 cifar100_mean   = [0.5071, 0.4867, 0.4408]
 cifar100_std    = [0.2675, 0.2565, 0.2761]
 
-def x_u_split(args, labels):
+def x_u_split(args, labels, rng=np.random):
     label_per_class = args.num_labeled // args.num_classes
     labels = np.array(labels)
-    labeled_idx = []
-    unlabeled_idx = np.array(range(len(labels)))
-    for i in range(args.num_classes):
-        idx = np.where(labels == i)[0]
-        idx = np.random.choice(idx, label_per_class, False)
-        labeled_idx.extend(idx)
-    labeled_idx = np.array(labeled_idx)
+    unlabeled_idx = np.arange(len(labels))
+    if np.bincount(labels, minlength=args.num_classes).min() < label_per_class:
+        raise ValueError('Every class needs at least {} samples'.format(
+            label_per_class))
+    # Group a random permutation by class, the first label_per_class entries
+    # of every class block are a uniform sample of that class
+    perm = rng.permutation(len(labels))
+    order = perm[np.argsort(labels[perm], kind='stable')]
+    class_start = np.searchsorted(labels[order], np.arange(args.num_classes))
+    labeled_idx = order[(class_start[:, None]
+                         + np.arange(label_per_class)).ravel()]
     assert len(labeled_idx) == args.num_labeled
 
+    rng.shuffle(labeled_idx)
+    return labeled_idx, unlabeled_idx
+
+def cached_split(args, root, names, make_split):
+    '''
+    args:
+        names       : (list) file names of the index arrays, holding every
+                      size the split depends on, e.g. 'labeled4000'
+        make_split  : function of a seeded np.random.RandomState returning
+                      the index arrays in the order of names
+    returns : (list) the index arrays, memory-mapped
+
+    Description:
+        Split manifest keyed by the dataset and --seed. The index arrays are
+        drawn once into <root>/splits/<dataset>-seed<seed>/ and every later
+        run, of any task or threshold, maps the same files, so the runs of a
+        seed train and evaluate on identical samples and the split is never
+        recomputed.
+    '''
+    split_dir = os.path.join(root, 'splits', '{}-seed{}'.format(args.dataset, args.seed))
+    paths = [os.path.join(split_dir, name + '.npy') for name in names]
+    if not all(os.path.exists(path) for path in paths):
+        os.makedirs(split_dir, exist_ok=True)
+        for path, idx in zip(paths, make_split(np.random.RandomState(args.seed))):
+            _save_npy(path, np.asarray(idx, dtype=np.int64))
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+
+def val_test_split(args, root, test_dataset, val_size):
+    '''
+    Splits the test set into the held-out test and the validation Subsets
+    with the index arrays of the split manifest (see cached_split).
+    '''
+    def make_split(rng):
+        perm = rng.permutation(len(test_dataset))
+        return perm[val_size:], perm[:val_size]
+    test_idxs, val_idxs = cached_split(
+        args, root, ['test{}'.format(len(test_dataset) - val_size), 'val{}'.format(val_size)],
+        make_split)
+    return Subset(test_dataset, test_idxs), Subset(test_dataset, val_idxs)
+
+
+def num_expanded_labels(args):
+    '''
+    Length of one pass over the labeled set. With --expand-labels (or fewer
+    labels than a batch) the labeled indices are repeated virtually by the
+    sampler to cover iter_per_epoch batches, the images are stored once.
+    '''
     if args.expand_labels or args.num_labeled < args.train_batch:
         num_expand_x = math.ceil(
             args.train_batch * args.iter_per_epoch / args.num_labeled)
-        labeled_idx = np.hstack([labeled_idx for _ in range(num_expand_x)])
-    np.random.shuffle(labeled_idx)
-    return labeled_idx, unlabeled_idx
+        return args.num_labeled * num_expand_x
+    return args.num_labeled
+
+class BatchWeakAugmentation:
+    '''
+    Vectorized version of the weak augmentation (RandomHorizontalFlip,
+    reflect-padded RandomCrop, ToTensor and Normalize) that works on whole
+    uint8 batches of shape [B, H, W, C] after collation instead of on single
+    PIL images. The flip and the reflect padding are folded into the crop
+    indices, so the augmented batch is produced by a single gather.
+    '''
+    def __init__(self, mean, std, train=True, padding=int(32*0.125)):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.train = train
+        self.padding = padding
+
+    def flip_crop(self, x):
+        b, h, w, _ = x.shape
+        p = self.padding
+        rows = torch.randint(0, 2*p + 1, (b, 1), device=x.device) - p
+        cols = torch.randint(0, 2*p + 1, (b, 1), device=x.device) - p
+        rows = _reflect(rows + torch.arange(h, device=x.device), h)
+        cols = _reflect(cols + torch.arange(w, device=x.device), w)
+        flip = torch.rand(b, 1, device=x.device) < 0.5
+        cols = torch.where(flip, w - 1 - cols, cols)
+        batch = torch.arange(b, device=x.device).view(b, 1, 1)
+        return x[batch, rows.unsqueeze(2), cols.unsqueeze(1)]
+
+    def normalize(self, x):
+        x = x.permute(0, 3, 1, 2).float().div_(255)
+        mean, std = self.mean.to(x.device), self.std.to(x.device)
+        return x.sub_(mean).div_(std).contiguous()
+
+    def __call__(self, x):
+        if self.train:
+            x = self.flip_crop(x)
+        return self.normalize(x)
+
+    def collate(self, batch):
+        # Only the [B, H, W, C] image batches are augmented, targets and
+        # sample indices pass through unchanged
+        return tuple(self(x) if x.dim() == 4 else x
+                     for x in default_collate(batch))
+
+def _reflect(idx, size):
+    idx = idx.abs()
+    return torch.where(idx > size - 1, 2*(size - 1) - idx, idx)
+
+def build_cifar_cache(dataset_cls, root):
+    '''
+    args:
+        dataset_cls : datasets.CIFAR10 or datasets.CIFAR100
+        root        : (str) The dataset root used by torchvision
+    returns : (str) The directory holding the cached arrays
+
+    Description:
+        One-time conversion of the pickled CIFAR batches into uint8 images
+        [N, 32, 32, 3] and int64 labels stored as .npy files, so the SSL
+        datasets can open them with a memory-map instead of unpickling the
+        batches again on every run.
+    '''
+    cache_dir = os.path.join(root, dataset_cls.base_folder + '-npy')
+    splits = {'train': dataset_cls.train_list, 'test': dataset_cls.test_list}
+    if all(os.path.exists(os.path.join(cache_dir, split + '_targets.npy'))
+           for split in splits):
+        return cache_dir
+
+    if not os.path.isdir(os.path.join(root, dataset_cls.base_folder)):
+        download_and_extract_archive(dataset_cls.url, root,
+                                     filename=dataset_cls.filename,
+                                     md5=dataset_cls.tgz_md5)
+    os.makedirs(cache_dir, exist_ok=True)
+    for split, file_list in splits.items():
+        data, targets = [], []
+        for file_name, _ in file_list:
+            file_path = os.path.join(root, dataset_cls.base_folder, file_name)
+            with open(file_path, 'rb') as f:
+                entry = pickle.load(f, encoding='latin1')
+            data.append(entry['data'])
+            targets.extend(entry['labels'] if 'labels' in entry
+                           else entry['fine_labels'])
+        data = np.vstack(data).reshape(-1, 3, 32, 32).transpose((0, 2, 3, 1))
+        # Write the labels last, their presence marks a complete split
+        _save_npy(os.path.join(cache_dir, split + '_data.npy'),
+                  np.ascontiguousarray(data, dtype=np.uint8))
+        _save_npy(os.path.join(cache_dir, split + '_targets.npy'),
+                  np.array(targets, dtype=np.int64))
+    return cache_dir
+
+def _save_npy(path, array):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+
+def make_synthetic_cifar(dataset_cls, root, num_train, num_test=10000, seed=0):
+    '''
+    args:
+        dataset_cls : datasets.CIFAR10 or datasets.CIFAR100
+        root        : (str) The dataset root the synthetic dataset goes to
+        num_train   : (int) Number of training images, spread over the
+                      training batch files
+        num_test    : (int) Number of test images
+    returns : (str) The directory holding the cached arrays
+
+    Description:
+        Writes a synthetic dataset without network access: the pickled
+        batches (and meta file) under root/<base_folder> in the layout
+        torchvision reads, and the .npy arrays of build_cifar_cache, filled
+        batch by batch so no split is ever held in memory twice. Every image
+        is uniform noise around a colour of its class, the classes are
+        balanced. The batches do not match the md5 sums torchvision checks,
+        so they are read through the cache. An existing dataset is reused.
+    '''
+    num_classes = 100 if issubclass(dataset_cls, datasets.CIFAR100) else 10
+    label_key = 'fine_labels' if num_classes == 100 else 'labels'
+    base_dir = os.path.join(root, dataset_cls.base_folder)
+    cache_dir = os.path.join(root, dataset_cls.base_folder + '-npy')
+    if os.path.exists(os.path.join(cache_dir, 'test_targets.npy')):
+        return cache_dir
+
+    os.makedirs(base_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    colours = rng.integers(0, 128, size=(num_classes, 3), dtype=np.uint8)
+    for split, file_list, num_images in (('train', dataset_cls.train_list, num_train),
+                                          ('test', dataset_cls.test_list, num_test)):
+        targets = rng.permutation(np.arange(num_images) % num_classes)
+        data_path = os.path.join(cache_dir, split + '_data.npy')
+        data = np.lib.format.open_memmap(data_path + '.tmp', mode='w+', dtype=np.uint8,
+                                         shape=(num_images, 32, 32, 3))
+        bounds = np.linspace(0, num_images, len(file_list) + 1).astype(np.int64)
+        for (file_name, _), start, end in zip(file_list, bounds[:-1], bounds[1:]):
+            labels = targets[start:end]
+            batch = rng.integers(0, 128, size=(end - start, 3, 1024), dtype=np.uint8)
+            batch += colours[labels][:, :, None]
+            entry = {'batch_label': file_name, label_key: labels.tolist(),
+                     'data': batch.reshape(-1, 3072),
+                     'filenames': ['{}_{}.png'.format(split, i) for i in range(start, end)]}
+            if num_classes == 100:
+                entry['coarse_labels'] = (labels // 5).tolist()
+            with open(os.path.join(base_dir, file_name), 'wb') as f:
+                pickle.dump(entry, f, protocol=4)
+            data[start:end] = batch.reshape(-1, 3, 32, 32).transpose((0, 2, 3, 1))
+        data.flush()
+        del data
+        os.replace(data_path + '.tmp', data_path)
+        # Write the labels last, their presence marks a complete split
+        _save_npy(os.path.join(cache_dir, split + '_targets.npy'),
+                  targets.astype(np.int64))
+
+    names = ['class{}'.format(i) for i in range(num_classes)]
+    meta = {dataset_cls.meta['key']: names}
+    if num_classes == 100:
+        meta['coarse_label_names'] = ['superclass{}'.format(i) for i in range(20)]
+    with open(os.path.join(base_dir, dataset_cls.meta['filename']), 'wb') as f:
+        pickle.dump(meta, f, protocol=4)
+    return cache_dir
+
+
+
+def share_dataset_memory(dataset):
+    '''
+    args:
+        dataset : a CIFAR dataset with numpy .data and .targets
+    returns : the same dataset
+
+    Description:
+        Moves the image and label arrays into shared memory (torch storages
+        backed by /dev/shm) before the DataLoader workers are forked. The
+        workers then map the same pages instead of holding a private
+        copy-on-write copy, and the targets stop being a list of Python ints
+        whose refcounts are touched on every access. Memory-mapped cache
+        arrays are already shared through the page cache and are left as is.
+    '''
+    if isinstance(dataset.data, np.memmap):
+        return dataset
+    data = torch.from_numpy(np.ascontiguousarray(dataset.data)).share_memory_()
+    targets = torch.from_numpy(
+        np.asarray(dataset.targets, dtype=np.int64)).share_memory_()
+    # Keep the tensors alive, the numpy arrays are views of their storage
+    dataset.shared_tensors = (data, targets)
+    dataset.data = data.numpy()
+    dataset.targets = targets.numpy()
+    return dataset
+
+def worker_memory():
+    '''
+    returns : (list) One dict per child process of the current process (the
+              DataLoader workers) with its pid and its total, anonymous and
+              shared-memory resident set size in MB. Empty where /proc is not
+              available.
+    '''
+    children = []
+    try:
+        for tid in os.listdir('/proc/self/task'):
+            with open('/proc/self/task/{}/children'.format(tid)) as f:
+                children.extend(int(pid) for pid in f.read().split())
+    except OSError:
+        return []
+    usage = []
+    for pid in sorted(children):
+        fields = {}
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('VmRSS', 'RssAnon', 'RssShmem'):
+                        fields[key] = int(value.split()[0]) / 1024
+        except OSError:
+            continue
+        usage.append({'pid': pid,
+                      'rss': fields.get('VmRSS', 0.0),
+                      'anon': fields.get('RssAnon', 0.0),
+                      'shared': fields.get('RssShmem', 0.0)})
+    return usage
+
+class InfiniteSampler(Sampler):
+    '''
+    Endless stream of dataset indices. Every pass over the dataset is
+    reshuffled with a generator seeded by (seed + pass), so the order only
+    depends on the seed and on the number of indices already drawn, which
+    makes the stream resumable from start. A pass can be longer than the
+    dataset (num_samples), the indices then repeat within the pass.
+    '''
+    def __init__(self, data_source, seed, start=0, num_samples=None):
+        self.num_items = len(data_source)
+        self.num_samples = num_samples or self.num_items
+        self.seed = seed
+        self.start = start
+
+    def __iter__(self):
+        epoch, offset = divmod(self.start, self.num_samples)
+        generator = torch.Generator()
+        while True:
+            generator.manual_seed(self.seed + epoch)
+            perm = torch.randperm(self.num_samples, generator=generator)
+            yield from (perm[offset:] % self.num_items).tolist()
+            epoch += 1
+            offset = 0
+
+class InfiniteDataLoader:
+    '''
+    Iterator over a DataLoader driven by an InfiniteSampler. The underlying
+    DataLoader iterator never raises StopIteration, so its worker processes
+    are started once and live for the whole run. state_dict() records the
+    sampler seed and the number of samples consumed, load_state_dict()
+    continues the exact same data order from there.
+    '''
+    def __init__(self, dataset, batch_size, num_workers, seed=None,
+                 num_samples=None, pin_memory=False):
+        if seed is None:
+            seed = int(torch.randint(2**31, ()).item())
+        self.dataset = dataset
+        self.sampler = InfiniteSampler(dataset, seed, num_samples=num_samples)
+        self.batch_size = batch_size
+        self.loader = DataLoader(dataset,
+                                 batch_size=batch_size,
+                                 sampler=self.sampler,
+                                 num_workers=num_workers,
+                                 collate_fn=dataset.collate_fn,
+                                 pin_memory=pin_memory,
+                                 persistent_workers=num_workers > 0)
+        self.consumed = 0
+        self._iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = iter(self.loader)
+        batch = next(self._iterator)
+        self.consumed += self.batch_size
+        return batch
+
+    def state_dict(self):
+        return {'seed': self.sampler.seed, 'consumed': self.consumed}
+
+    def load_state_dict(self, state):
+        self.sampler.seed = state['seed']
+        self.sampler.start = self.consumed = state['consumed']
+        # Creating the iterator draws the DataLoader base seed from the global
+        # RNG, do it now so restoring the RNG state afterwards is exact
+        self._iterator = iter(self.loader)
+
+class Prefetcher:
+    '''
+    Keeps up to `depth` batches of a DataLoader or InfiniteDataLoader staged
+    on `device`. A background thread draws the batches and, with CUDA, pins
+    them and copies them with non_blocking=True on a side stream, so loading
+    and host-to-device copies overlap with the compute of the main thread.
+    With depth=0 batches are loaded and moved synchronously. wait_time is the
+    total time the consumer spent blocked on the input pipeline, copy_time
+    the host-to-device copy time of the last batch (with time_copies the
+    prefetch thread waits for the CUDA copy to finish so it is measured).
+    A loader without worker processes draws its augmentations from the
+    global RNG that the main thread draws from as well, so its batches are
+    loaded synchronously and the run stays deterministic.
+    '''
+    def __init__(self, loader, device, depth=2, time_copies=False):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = device
+        num_workers = getattr(loader, 'loader', loader).num_workers
+        self.depth = depth if num_workers > 0 else 0
+        self.time_copies = time_copies
+        self.stream = None
+        if device.type == 'cuda':
+            self.stream = torch.cuda.Stream(device)
+        self.wait_time = 0.0
+        self.copy_time = 0.0
+        self.consumed = getattr(loader, 'consumed', 0)
+        self._iterator = None
+        self._queue = None
+        self._thread = None
+        self._stop = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def state_dict(self):
+        # The loader has run ahead by the staged batches, the position to
+        # resume from is the one of the batches handed out
+        state = self.loader.state_dict()
+        state['consumed'] = self.consumed
+        return state
+
+    def load_state_dict(self, state):
+        self.close()
+        self.loader.load_state_dict(state)
+        self.consumed = state['consumed']
+
+    def reset_wait_time(self):
+        wait_time, self.wait_time = self.wait_time, 0.0
+        return wait_time
+
+    def _to_device(self, batch):
+        start = time.perf_counter()
+        if self.stream is None:
+            batch = tuple(t.to(self.device) for t in batch)
+            return batch, None, time.perf_counter() - start
+        with torch.cuda.stream(self.stream):
+            batch = tuple(t.pin_memory().to(self.device, non_blocking=True)
+                          if not t.is_cuda else t for t in batch)
+            event = torch.cuda.Event()
+            event.record()
+        if self.time_copies:
+            event.synchronize()
+        return batch, event, time.perf_counter() - start
+
+    def _worker(self, iterator, queue, stop):
+        try:
+            for batch in iterator:
+                item = self._to_device(batch)
+                while not stop.is_set():
+                    try:
+                        queue.put(item, timeout=0.1)
+                        break
+                    except Full:
+                        pass
+                if stop.is_set():
+                    return
+            item = StopIteration()
+        except Exception as e:
+            item = e
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        self._iterator = self._queue = self._thread = self._stop = None
+
+    def __iter__(self):
+        # Every pass over a finite loader starts a new epoch
+        self.close()
+        self._iterator = iter(self.loader)
+        if self.depth > 0:
+            self._queue = Queue(maxsize=self.depth)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._worker,
+                args=(self._iterator, self._queue, self._stop), daemon=True)
+            self._thread.start()
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            iter(self)
+        start = time.perf_counter()
+        if self._thread is None:
+            batch, event, self.copy_time = self._to_device(next(self._iterator))
+        else:
+            item = self._queue.get()
+            if isinstance(item, BaseException):
+                self.close()
+                raise item
+            batch, event, self.copy_time = item
+        if event is not None:
+            # The copies were issued on the side stream, order them before
+            # any kernel of the current stream that reads the batch
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            for t in batch:
+                t.record_stream(stream)
+        self.wait_time += time.perf_counter() - start
+        self.consumed += self.loader.batch_size
+        return batch
+
+class TensorEvalLoader:
+    '''
+    Evaluation loader over a dataset that is decoded, transformed and moved
+    to `device` once. The images are kept as a single [N, C, H, W] tensor,
+    optionally float16 and/or channels_last, and every pass hands out
+    contiguous slices of it in dataset order, so an evaluation costs no
+    decoding, worker IPC or host-to-device copies. float16 batches are cast
+    back to float32 for the model.
+    '''
+    def __init__(self, dataset, batch_size, device, dtype=torch.float32,
+                 channels_last=False, num_workers=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        images, labels = [], []
+        # An own generator keeps the global RNG stream of the run untouched
+        for x, y in DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                               num_workers=num_workers, generator=torch.Generator()):
+            images.append(x.to(device, dtype))
+            labels.append(y.to(device))
+        self.images = torch.cat(images)
+        if channels_last:
+            self.images = self.images.contiguous(memory_format=torch.channels_last)
+        self.labels = torch.cat(labels)
+
+    def __len__(self):
+        return math.ceil(len(self.labels) / self.batch_size)
+
+    def __iter__(self):
+        for start in range(0, len(self.labels), self.batch_size):
+            end = start + self.batch_size
+            yield self.images[start:end].float(), self.labels[start:end]
 
 def get_cifar10(args, root):
     transform_labeled = transforms.Compose([
@@ -43,21 +549,48 @@ def get_cifar10(args, root):
         transforms.ToTensor(),
         transforms.Normalize(mean=cifar10_mean, std=cifar10_std)
     ])
-    base_dataset = datasets.CIFAR10(root, train=True, download=True)
-
-    train_labeled_idxs, train_unlabeled_idxs = x_u_split(
-        args, base_dataset.targets)
+    cache_dir = None
+    if args.synthetic:
+        make_synthetic_cifar(datasets.CIFAR10, root, args.synthetic)
+    if args.data_cache:
+        cache_dir = build_cifar_cache(datasets.CIFAR10, root)
+        base_targets = lambda: np.load(os.path.join(cache_dir, 'train_targets.npy'),
+                                       mmap_mode='r')
+    else:
+        base_targets = lambda: datasets.CIFAR10(root, train=True, download=True).targets
+
+    # The targets are only read when the split of this seed is not cached yet
+    train_labeled_idxs, train_unlabeled_idxs = cached_split(
+        args, root, ['labeled{}'.format(args.num_labeled), 'unlabeled{}'.format(args.num_labeled)],
+        lambda rng: x_u_split(args, base_targets(), rng))
+
+    batch_transform = None
+    if args.batch_augment:
+        batch_transform = BatchWeakAugmentation(cifar10_mean, cifar10_std)
+        transform_labeled = None
 
     train_labeled_dataset = CIFAR10SSL(
         root, train_labeled_idxs, train=True,
-        transform=transform_labeled)
+        transform=transform_labeled, batch_transform=batch_transform,
+        cache_dir=cache_dir)
 
     train_unlabeled_dataset = CIFAR10SSL(
         root, train_unlabeled_idxs, train=True,
-        transform=transform_labeled)
-
-    test_dataset = datasets.CIFAR10(
-        root, train=False, transform=transform_val, download=False)
+        transform=transform_labeled, batch_transform=batch_transform,
+        cache_dir=cache_dir, return_index=args.vat_cache is not None)
+
+    if cache_dir is not None:
+        test_dataset = CIFAR10SSL(
+            root, None, train=False, transform=transform_val,
+            cache_dir=cache_dir)
+    else:
+        test_dataset = datasets.CIFAR10(
+            root, train=False, transform=transform_val, download=False)
+
+    if args.shared_memory:
+        for dataset in (train_labeled_dataset, train_unlabeled_dataset,
+                        test_dataset):
+            share_dataset_memory(dataset)
 
     return train_labeled_dataset, train_unlabeled_dataset, test_dataset
 
@@ -76,73 +609,197 @@ def get_cifar100(args, root):
         transforms.ToTensor(),
         transforms.Normalize(mean=cifar100_mean, std=cifar100_std)])
 
-    base_dataset = datasets.CIFAR100(
-        root, train=True, download=True)
-
-    train_labeled_idxs, train_unlabeled_idxs = x_u_split(
-        args, base_dataset.targets)
+    cache_dir = None
+    if args.synthetic:
+        make_synthetic_cifar(datasets.CIFAR100, root, args.synthetic)
+    if args.data_cache:
+        cache_dir = build_cifar_cache(datasets.CIFAR100, root)
+        base_targets = lambda: np.load(os.path.join(cache_dir, 'train_targets.npy'),
+                                       mmap_mode='r')
+    else:
+        base_targets = lambda: datasets.CIFAR100(root, train=True, download=True).targets
+
+    # The targets are only read when the split of this seed is not cached yet
+    train_labeled_idxs, train_unlabeled_idxs = cached_split(
+        args, root, ['labeled{}'.format(args.num_labeled), 'unlabeled{}'.format(args.num_labeled)],
+        lambda rng: x_u_split(args, base_targets(), rng))
+
+    batch_transform = None
+    if args.batch_augment:
+        batch_transform = BatchWeakAugmentation(cifar100_mean, cifar100_std)
+        transform_labeled = None
 
     train_labeled_dataset = CIFAR100SSL(
         root, train_labeled_idxs, train=True,
-        transform=transform_labeled)
+        transform=transform_labeled, batch_transform=batch_transform,
+        cache_dir=cache_dir)
 
     train_unlabeled_dataset = CIFAR100SSL(
         root, train_unlabeled_idxs, train=True,
-        transform=transform_labeled)
-
-    test_dataset = datasets.CIFAR100(
-        root, train=False, transform=transform_val, download=False)
+        transform=transform_labeled, batch_transform=batch_transform,
+        cache_dir=cache_dir, return_index=args.vat_cache is not None)
+
+    if cache_dir is not None:
+        test_dataset = CIFAR100SSL(
+            root, None, train=False, transform=transform_val,
+            cache_dir=cache_dir)
+    else:
+        test_dataset = datasets.CIFAR100(
+            root, train=False, transform=transform_val, download=False)
+
+    if args.shared_memory:
+        for dataset in (train_labeled_dataset, train_unlabeled_dataset,
+                        test_dataset):
+            share_dataset_memory(dataset)
 
     return train_labeled_dataset, train_unlabeled_dataset, test_dataset
 
 class CIFAR10SSL(datasets.CIFAR10):
     def __init__(self, root, indexs, train=True,
                  transform=None, target_transform=None,
-                 download=False):
-        super().__init__(root, train=train,
-                         transform=transform,
-                         target_transform=target_transform,
-                         download=download)
-        if indexs is not None:
-            self.data = self.data[indexs]
-            self.targets = np.array(self.targets)[indexs]
+                 download=False, batch_transform=None, cache_dir=None,
+                 return_index=False):
+        self.indexs = None
+        self.cache_dir = cache_dir
+        self.return_index = return_index
+        if cache_dir is not None:
+            # Memory-map the arrays written by build_cifar_cache, indexs are
+            # applied lazily so every worker reads the same page-cache pages
+            datasets.VisionDataset.__init__(self, root, transform=transform,
+                                            target_transform=target_transform)
+            self.train = train
+            self._open_cache()
+            self.indexs = indexs
+        else:
+            super().__init__(root, train=train,
+                             transform=transform,
+                             target_transform=target_transform,
+                             download=download)
+            if indexs is not None:
+                self.data = self.data[indexs]
+                self.targets = np.array(self.targets)[indexs]
+        # With a batch transform the dataset yields raw uint8 [H, W, C]
+        # images and the augmentation runs on the collated batch
+        self.collate_fn = None
+        if batch_transform is not None:
+            self.collate_fn = batch_transform.collate
+
+    def __getstate__(self):
+        # Reopen the memory-map in the unpickling process instead of
+        # copying the arrays, e.g. for spawned DataLoader workers
+        state = self.__dict__.copy()
+        if self.cache_dir is not None:
+            del state['data'], state['targets']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cache_dir is not None:
+            self._open_cache()
+
+    def _open_cache(self):
+        split = 'train' if self.train else 'test'
+        self.data = np.load(
+            os.path.join(self.cache_dir, split + '_data.npy'), mmap_mode='r')
+        self.targets = np.load(
+            os.path.join(self.cache_dir, split + '_targets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        if self.indexs is not None:
+            return len(self.indexs)
+        return len(self.data)
 
     def __getitem__(self, index):
+        position = index
+        if self.indexs is not None:
+            index = self.indexs[index]
         img, target = self.data[index], self.targets[index]
-        img = Image.fromarray(img)
 
         if self.transform is not None:
-            img = self.transform(img)
+            img = self.transform(Image.fromarray(img))
+        else:
+            img = torch.tensor(img)
 
         if self.target_transform is not None:
             target = self.target_transform(target)
 
         target = torch.tensor(target)
-        return torch.tensor(img), target.long()
+        if self.return_index:
+            return img, target.long(), position
+        return img, target.long()
 
 
 class CIFAR100SSL(datasets.CIFAR100):
     def __init__(self, root, indexs, train=True,
                  transform=None, target_transform=None,
-                 download=False):
-        super().__init__(root, train=train,
-                         transform=transform,
-                         target_transform=target_transform,
-                         download=download)
-        if indexs is not None:
-            self.data = self.data[indexs]
-            self.targets = np.array(self.targets)[indexs]
+                 download=False, batch_transform=None, cache_dir=None,
+                 return_index=False):
+        self.indexs = None
+        self.cache_dir = cache_dir
+        self.return_index = return_index
+        if cache_dir is not None:
+            # Memory-map the arrays written by build_cifar_cache, indexs are
+            # applied lazily so every worker reads the same page-cache pages
+            datasets.VisionDataset.__init__(self, root, transform=transform,
+                                            target_transform=target_transform)
+            self.train = train
+            self._open_cache()
+            self.indexs = indexs
+        else:
+            super().__init__(root, train=train,
+                             transform=transform,
+                             target_transform=target_transform,
+                             download=download)
+            if indexs is not None:
+                self.data = self.data[indexs]
+                self.targets = np.array(self.targets)[indexs]
+        # With a batch transform the dataset yields raw uint8 [H, W, C]
+        # images and the augmentation runs on the collated batch
+        self.collate_fn = None
+        if batch_transform is not None:
+            self.collate_fn = batch_transform.collate
+
+    def __getstate__(self):
+        # Reopen the memory-map in the unpickling process instead of
+        # copying the arrays, e.g. for spawned DataLoader workers
+        state = self.__dict__.copy()
+        if self.cache_dir is not None:
+            del state['data'], state['targets']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cache_dir is not None:
+            self._open_cache()
+
+    def _open_cache(self):
+        split = 'train' if self.train else 'test'
+        self.data = np.load(
+            os.path.join(self.cache_dir, split + '_data.npy'), mmap_mode='r')
+        self.targets = np.load(
+            os.path.join(self.cache_dir, split + '_targets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        if self.indexs is not None:
+            return len(self.indexs)
+        return len(self.data)
 
     def __getitem__(self, index):
+        position = index
+        if self.indexs is not None:
+            index = self.indexs[index]
         img, target = self.data[index], self.targets[index]
-        img = Image.fromarray(img)
 
         if self.transform is not None:
-            img = self.transform(img)
+            img = self.transform(Image.fromarray(img))
+        else:
+            img = torch.tensor(img)
 
         if self.target_transform is not None:
             target = self.target_transform(target)
 
         target = torch.tensor(target)
-        return torch.tensor(img), target.long()
+        if self.return_index:
+            return img, target.long(), position
+        return img, target.long()
 
@@ -5,18 +5,19 @@ import math
 import os
 import logging
 import random
+import time
 
-from dataloader import get_cifar10, get_cifar100
-from vat        import VATLoss
-from utils      import accuracy
+from dataloader import get_cifar10, get_cifar100, InfiniteDataLoader, Prefetcher, TensorEvalLoader, val_test_split, worker_memory, num_expanded_labels
+from vat        import VATLoss, PerturbationCache, freeze_bn_stats
+from utils      import accuracy, StageTimer, MetricAccumulator, build_profiler
 from model.wrn  import WideResNet
 
 import torch
 import torch.optim as optim
 import torch.nn as nn
 from torch.utils.data   import DataLoader
-from torch.utils.data import random_split
-from test import test_cifar10, test_cifar100, load_checkpoint, save_checkpoint
+from test import test_cifar10, test_cifar100, load_checkpoint, save_checkpoint, CheckpointWriter, \
+    rng_state, set_rng_state, restore_initial_rng, load_resume_state, mark_completed, PreemptionHandler
 
 
 curr_path = os.path.dirname(os.path.abspath(__file__))
@@ -27,6 +28,16 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(
 
 def main(args):
     
+    resume_path = os.path.join(args.dataout, 'resume.task2.pt')
+    restore_initial_rng(os.path.join(args.dataout, 'resume.task2.rng.pt'), args.resume)
+    resume = load_resume_state(resume_path, args.resume)
+    if resume is not None and resume.get('completed') == 'test':
+        logging.info('Nothing to resume, the run is complete')
+        return
+    if args.synthetic:
+        # Generated CIFAR-format data of its own root, read through the cache
+        args.datapath = os.path.join(args.datapath, 'synthetic-{}'.format(args.synthetic))
+        args.data_cache = True
     if args.dataset == "cifar10":
         args.num_classes = 10
         labeled_dataset, unlabeled_dataset, test_dataset = get_cifar10(args, 
@@ -40,28 +51,44 @@ def main(args):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     
     val_size = 1000
-    test_size = len(test_dataset) - val_size
-    test_dataset, val_ds = random_split(test_dataset, [test_size, val_size])
+    test_dataset, val_ds = val_test_split(args, args.datapath, test_dataset, val_size)
 
-    labeled_loader      = iter(DataLoader(labeled_dataset, 
+    labeled_loader      = InfiniteDataLoader(labeled_dataset, 
                                     batch_size = args.train_batch, 
-                                    shuffle = True, 
-                                    num_workers=args.num_workers))
+                                    num_workers=args.num_workers,
+                                    num_samples=num_expanded_labels(args),
+                                    pin_memory=device.type == 'cuda')
     
-    unlabeled_loader    = iter(DataLoader(unlabeled_dataset, 
+    unlabeled_loader    = InfiniteDataLoader(unlabeled_dataset, 
                                     batch_size=args.train_batch,
-                                    shuffle = True, 
-                                    num_workers=args.num_workers))
+                                    num_workers=args.num_workers,
+                                    pin_memory=device.type == 'cuda')
     
     test_loader         = DataLoader(test_dataset,
                                     batch_size = args.test_batch,
                                     shuffle = False, 
-                                    num_workers=args.num_workers)
+                                    num_workers=args.num_workers,
+                                    pin_memory=device.type == 'cuda')
     
     validation_loader          = DataLoader(val_ds,
                                     batch_size = args.test_batch,
                                     shuffle = False, 
-                                    num_workers=args.num_workers)
+                                    num_workers=args.num_workers,
+                                    pin_memory=device.type == 'cuda')
+    
+    # Stage the batches on the device ahead of the loop
+    labeled_loader, unlabeled_loader, test_loader, validation_loader = [
+        Prefetcher(loader, device, args.prefetch, time_copies=args.timing) for loader in
+        (labeled_loader, unlabeled_loader, test_loader, validation_loader)]
+
+    if args.eval_data == 'memory':
+        # The validation and test images are decoded and normalized once
+        test_loader, validation_loader = [
+            TensorEvalLoader(dataset, args.test_batch, device,
+                             dtype=getattr(torch, args.eval_dtype),
+                             channels_last=args.eval_channels_last,
+                             num_workers=args.num_workers)
+            for dataset in (test_dataset, val_ds)]
     
     model       = WideResNet(args.model_depth, 
                                 args.num_classes, widen_factor=args.model_width)
@@ -77,14 +104,6 @@ def main(args):
     
     torch.save(model.state_dict(), init_path)
     
-    def save_checkpoint(checkpoint, best_path):
-        
-        logging.info('Saving model of epoch %s with validation accuracy = %.3f and loss = %.3f',
-                     checkpoint['epoch'], checkpoint['validation_accuracy'], checkpoint['validation_loss'])
-
-        torch.save(checkpoint, best_path)
-
-    
     loss_fn = nn.CrossEntropyLoss()
     
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
@@ -93,92 +112,154 @@ def main(args):
     
     best_loss = float('inf')
     best_path = os.path.join(curr_path, 'best_model.pt')
+    checkpoint_writer = CheckpointWriter()
 
     vatLoss = VATLoss(args)
+    timer = StageTimer(args.timing, os.path.join(curr_path, 'out.task2.timing.jsonl'),
+                       sync_cuda=args.timing and device.type == 'cuda')
+    if args.vat_cache is not None:
+        vatLoss.cache = PerturbationCache(args.vat_cache,
+                                          len(unlabeled_dataset), (3, 32, 32))
+
+    train_metrics = MetricAccumulator(args.num_classes, device)
+    val_metrics = MetricAccumulator(args.num_classes, device)
+
+    preemption = PreemptionHandler()
+    
+    def resume_state(epoch, iteration):
+        # The cached VAT directions live in their own memory-mapped file
+        if vatLoss.cache is not None:
+            vatLoss.cache.flush()
+        return {
+            'epoch': epoch,
+            'iteration': iteration,
+            'state_dict': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'labeled_loader': labeled_loader.state_dict(),
+            'unlabeled_loader': unlabeled_loader.state_dict(),
+            'rng': rng_state(),
+            'best_loss': best_loss,
+            'train_metrics': train_metrics.state_dict(),
+        }
+    
+    start_epoch = 0
+    if resume is not None and resume.get('completed') == 'train':
+        # Only the evaluation of the best model is left
+        resume, start_epoch = None, args.epoch
+    if resume is not None:
+        model.load_state_dict(resume['state_dict'])
+        optimizer.load_state_dict(resume['optimizer'])
+        scheduler.load_state_dict(resume['scheduler'])
+        labeled_loader.load_state_dict(resume['labeled_loader'])
+        unlabeled_loader.load_state_dict(resume['unlabeled_loader'])
+        set_rng_state(resume['rng'])
+        best_loss = resume['best_loss']
+        start_epoch = resume['epoch']
 
     ############################################################################
     # TODO: SUPPLY your code
     ############################################################################
     
-    for epoch in range(args.epoch):
+    profiler = build_profiler(args, 'task2')
+    profiler.start()
+    for epoch in range(start_epoch, args.epoch):
               
         loss_list = []
-        correct = 0
-        running_loss = 0.0
-        total = 0
+        train_metrics.reset()
+        first_iter = 0
+        if resume is not None:
+            # Continue the interrupted epoch
+            first_iter = resume['iteration']
+            train_metrics.load_state_dict(resume['train_metrics'])
+            resume = None
         
         print("epoch: ", epoch+1)
         
         model.train()
+        epoch_start = time.perf_counter()
         
-        for i in range(args.iter_per_epoch):
-            try:
-                x_l, y_l    = next(labeled_loader)
-            except StopIteration:
-                labeled_loader      = iter(DataLoader(labeled_dataset, 
-                                            batch_size = args.train_batch, 
-                                            shuffle = True, 
-                                            num_workers=args.num_workers))
-                x_l, y_l    = next(labeled_loader)
+        for i in range(first_iter, args.iter_per_epoch):
+            timer.mark()
+            x_l, y_l    = next(labeled_loader)
             
-            try:
+            if args.vat_cache is not None:
+                x_ul, _, idx_ul = next(unlabeled_loader)
+            else:
                 x_ul, _     = next(unlabeled_loader)
-            except StopIteration:
-                unlabeled_loader    = iter(DataLoader(unlabeled_dataset, 
-                                            batch_size=args.train_batch,
-                                            shuffle = True, 
-                                            num_workers=args.num_workers))
-                x_ul, _     = next(unlabeled_loader)
-            
-            x_l, y_l    = x_l.to(device), y_l.to(device)
-            
-            x_ul        = x_ul.to(device)
+                idx_ul      = None
+            timer.lap('data_wait')
+            timer.add('h2d_copy', labeled_loader.copy_time + unlabeled_loader.copy_time)
             ####################################################################
             # TODO: SUPPLY you code
             ###################################################################
             
             optimizer.zero_grad()
             
-            vaLoss = vatLoss(model, x_ul)
-            pred = model(x_l)
+            if args.vat_forward == 'fused':
+                # One forward (and one BatchNorm update) for the labeled and
+                # the clean unlabeled batch, the adversarial forwards only
+                # use the batch statistics
+                pred, logits_ul = torch.split(model(torch.cat((x_l, x_ul))),
+                                              [x_l.shape[0], x_ul.shape[0]])
+                timer.lap('forward')
+                with freeze_bn_stats(model):
+                    vaLoss = vatLoss(model, x_ul, idx_ul, logits_ul)
+                timer.lap('vat')
+            else:
+                vaLoss = vatLoss(model, x_ul, idx_ul)
+                timer.lap('vat')
+                pred = model(x_l)
+                timer.lap('forward')
             classifcationLoss = loss_fn(pred, y_l)
             loss = classifcationLoss + args.alpha*vaLoss
             loss.backward()
-            running_loss += loss.item()
+            timer.lap('backward')
             optimizer.step()
+            timer.lap('optimizer')
+            timer.count(x_l.shape[0] + x_ul.shape[0])
+            profiler.step()
             
-            correct += (torch.argmax(pred, axis=1)
-                            == y_l).float().sum()
-            total += float(x_l.size(dim=0))      
+            train_metrics.update(pred, y_l, loss)
             
-            running_loss += loss.item()
+            if preemption.requested:
+                checkpoint_writer.save(resume_state(epoch, i + 1), resume_path)
+                checkpoint_writer.close()
+                preemption.exit()
+            if args.checkpoint_every and (epoch * args.iter_per_epoch + i + 1) % args.checkpoint_every == 0:
+                checkpoint_writer.save(resume_state(epoch, i + 1), resume_path)
+        
+        logging.info('Epoch %s/%s, Throughput: %.1f iterations/s (%s VAT forward)',
+                     epoch+1, args.epoch,
+                     args.iter_per_epoch / (time.perf_counter() - epoch_start),
+                     args.vat_forward)
+        logging.info('Epoch %s/%s, Data wait: %.2f ms/iteration',
+                     epoch+1, args.epoch,
+                     1000 * (labeled_loader.reset_wait_time()
+                             + unlabeled_loader.reset_wait_time()) / args.iter_per_epoch)
         
-        train_accuracy = 100 * correct / total
-        running_loss /= args.iter_per_epoch
+        train_result = train_metrics.compute()
+        train_accuracy, running_loss = train_result['top1'], train_result['loss']
         loss_list.append(running_loss)
             
         
         
+        timer.mark()
         with torch.no_grad():
             model.eval()
-            test_loss = 0.0
-            correct = 0.0
-            for j, (x_v, y_v) in enumerate(validation_loader):
-                x_v, y_v = x_v.to(device), y_v.to(device)
+            val_metrics.reset()
+            for x_v, y_v in validation_loader:
                 y_op_val = model(x_v)
-                loss = loss_fn(y_op_val, y_v)
+                val_metrics.update(y_op_val, y_v, loss_fn(y_op_val, y_v))
 
-                test_loss += loss.item()
-                _, y_pred_test = y_op_val.max(1)
-                correct += y_pred_test.eq(y_v).sum()
-
-            test_accuracy = 100 * correct.float() / len(validation_loader.dataset)
-            test_loss = test_loss / j
+            val_result = val_metrics.compute()
+            test_accuracy, test_loss = val_result['top1'], val_result['loss']
+            timer.lap('validation')
 
             logging.info("Epoch %s/%s, Train Accuracy: %.3f, Test Accuracy: %.3f, Training Loss: %.3f, Test Loss: %.3f",
                 epoch+1,
                 args.epoch,
-                train_accuracy.item(),
+                train_accuracy,
                 test_accuracy,
                 running_loss,
                 test_loss
@@ -192,20 +273,32 @@ def main(args):
                       'validation_accuracy': test_accuracy,
                       'state_dict': model.state_dict(),
                   }
-                save_checkpoint(checkpoint, best_path)
+                save_checkpoint(checkpoint, best_path, checkpoint_writer)
             
+        timer.log(epoch+1)
+        if args.report_memory:
+            for usage in worker_memory():
+                logging.info('Worker %s: RSS = %.1f MB, anonymous = %.1f MB, shared = %.1f MB',
+                             usage['pid'], usage['rss'], usage['anon'], usage['shared'])
+
         scheduler.step(test_loss)
 
         print("Epoch {}/{}, Train Accuracy: {:.3f}, Test Accuracy: {:.3f}, Training Loss: {:.3f}, Test Loss: {:.3f}".format(
                 epoch+1,
                 args.epoch,
-                train_accuracy.item(),
+                train_accuracy,
                 test_accuracy,
                 running_loss,
                 test_loss
             ))
   
     
+    profiler.stop()
+    if vatLoss.cache is not None:
+        vatLoss.cache.flush()
+    # The best checkpoint has to be on disk before it is evaluated
+    checkpoint_writer.close()
+    mark_completed(resume_path, 'train')
     logging.info('Training Complete...')
 
     # Model Evaluation
@@ -216,6 +309,7 @@ def main(args):
         
     elif args.dataset == "cifar100":
         test_cifar100(args, device, test_loader, best_path)
+    mark_completed(resume_path, 'test')
             
 
 
@@ -227,6 +321,9 @@ if __name__ == "__main__":
                         type=str, choices=["cifar10", "cifar100"])
     parser.add_argument("--datapath", default="./data/", 
                         type=str, help="Path to the CIFAR-10/100 dataset")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="seed of the labeled/unlabeled and validation/test splits, the splits "
+                             "are drawn once per seed and cached under <datapath>/splits")
     parser.add_argument('--num-labeled', type=int, 
                         default=4000, help='Total number of labeled samples')
     
@@ -240,6 +337,28 @@ if __name__ == "__main__":
     
     parser.add_argument("--expand-labels", action="store_true", 
                         help="expand labels to fit eval steps")
+    parser.add_argument("--batch-augment", action="store_true",
+                        help="apply the weak augmentation to whole collated batches instead of per sample")
+    parser.add_argument("--synthetic", default=0, type=int,
+                        help="train on this many generated CIFAR-format images written to "
+                             "<datapath>/synthetic-N instead of the real dataset, needs no "
+                             "download (implies --data-cache)")
+    parser.add_argument("--data-cache", action="store_true",
+                        help="convert CIFAR once into .npy files under the datapath and memory-map them")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="move the dataset arrays to shared memory before the workers start")
+    parser.add_argument("--report-memory", action="store_true",
+                        help="log the resident memory of every DataLoader worker after each epoch")
+    parser.add_argument("--eval-data", default="loader", type=str, choices=["loader", "memory"],
+                        help="'memory' keeps the normalized validation and test images on the device "
+                             "and evaluates without DataLoader workers")
+    parser.add_argument("--eval-dtype", default="float32", type=str, choices=["float32", "float16"],
+                        help="storage type of the images with --eval-data memory")
+    parser.add_argument("--eval-channels-last", action="store_true",
+                        help="store the images channels_last with --eval-data memory")
+    parser.add_argument("--save-logits", action="store_true",
+                        help="write the test logits of the best model next to its checkpoint "
+                             "as a memory-mapped .npy file")
     
     parser.add_argument('--train-batch', default=64, type=int,
                         help='train batchsize')
@@ -251,6 +370,25 @@ if __name__ == "__main__":
     parser.add_argument('--iter-per-epoch', default=1024, type=int,
                         help="Number of iterations to run per epoch")
     
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the resumable checkpoint in --dataout if there is one")
+    parser.add_argument("--checkpoint-every", default=200, type=int,
+                        help="iterations between resumable checkpoints (0 = only on SIGTERM)")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile a window of training iterations with torch.profiler, "
+                             "the Chrome trace, stacks and operator table are written to --dataout")
+    parser.add_argument("--profile-wait", default=5, type=int,
+                        help="iterations to skip before the profiler warms up")
+    parser.add_argument("--profile-warmup", default=2, type=int,
+                        help="profiler warm-up iterations, recorded but discarded")
+    parser.add_argument("--profile-active", default=5, type=int,
+                        help="iterations recorded by the profiler")
+    parser.add_argument("--profile-rows", default=30, type=int,
+                        help="rows of the operator table")
+    parser.add_argument("--timing", action="store_true",
+                        help="record per-stage timings of the training loop, logged per epoch and appended to out.task2*.timing.jsonl")
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help="Number of batches staged on the device ahead of the training loop (0 = synchronous)")
     parser.add_argument('--num-workers', default=1, type=int,
                         help="Number of workers to launch during training")  
     
@@ -269,6 +407,12 @@ if __name__ == "__main__":
                         help="VAT epsilon parameter") 
     parser.add_argument("--vat-iter", default=1, type=int, 
                         help="VAT iteration parameter") 
+    parser.add_argument("--vat-forward", default="separate", type=str,
+                        choices=["separate", "fused"],
+                        help="'fused' runs the labeled and the clean unlabeled batch through one forward "
+                             "and freezes the BatchNorm running stats during the adversarial forwards")
+    parser.add_argument("--vat-cache", default=None, type=str,
+                        help="memory-mapped file that keeps the last VAT direction of every unlabeled sample to warm-start the power iteration")
     # Add more arguments if you need them
     # Describe them in help
     # You can (and should) change the default values of the arguments
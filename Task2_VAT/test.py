@@ -1,11 +1,17 @@
 import logging
 import os
+import random
+import signal
+import sys
+import threading
+from collections import OrderedDict
 
+import numpy as np
 import torch
 from dataloader import get_cifar10, get_cifar100
 from model.wrn import WideResNet
 import torch.nn as nn
-from utils import accuracy
+from utils import MetricAccumulator
 
 curr_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -30,8 +36,8 @@ def test_cifar10(args, device, testdataset, filepath = "./path/to/model.pth.tar"
     model = model.to(device)
     _, model = load_checkpoint(filepath, model)
     criterion = nn.CrossEntropyLoss()
-    logits = evaluate_model(model, testdataset, criterion, device)
-    top1, topk = find_model_accuracy(model, testdataset, device)
+    logits_path = os.path.splitext(filepath)[0] + '.logits.npy' if args.save_logits else None
+    logits, _ = evaluate(model, testdataset, device, criterion, logits_path)
     return logits
     # raise NotImplementedError
 
@@ -56,8 +62,8 @@ def test_cifar100(args, device, testdataset, filepath="./path/to/model.pth.tar")
     model = model.to(device)
     _, model = load_checkpoint(filepath, model)
     criterion = nn.CrossEntropyLoss()
-    logits = evaluate_model(model, testdataset, criterion, device)
-    top1, topk = find_model_accuracy(model, testdataset, device)
+    logits_path = os.path.splitext(filepath)[0] + '.logits.npy' if args.save_logits else None
+    logits, _ = evaluate(model, testdataset, device, criterion, logits_path)
     return logits
     # raise NotImplementedError
 
@@ -66,51 +72,233 @@ def load_checkpoint(ckpt_path, model):
     model.load_state_dict(checkpoint['state_dict'])
     return checkpoint['validation_loss'], model
 
-def evaluate_model(model, test_loader, criterion, device):
+def evaluate(model, test_loader, device, criterion=None, logits_path=None):
+    '''
+    args:
+        test_loader : batches of (images, labels) in the order of its dataset
+        criterion   : (optional) loss averaged over a batch
+        logits_path : (optional) .npy file the logits are written to through
+                      a memory map instead of being kept in memory
+    returns : (torch.Tensor, dict) logits of shape [num_samples, num_classes]
+                on the host, and the loss, top-1/top-5 accuracy, per-class
+                accuracy and confusion matrix (rows are the labels)
+
+    Description:
+        One pass over test_loader. The logits of every batch are written
+        into a single [num_samples, num_classes] buffer, preallocated on the
+        device or in the memory-mapped file, and the metrics are summed on
+        the device, so nothing is read back before the end of the pass.
+        Every sample counts once, the last short batch included.
+    '''
     with torch.no_grad():
         model.eval()
-        test_loss = 0.0
-        correct = 0.0
-        y_logits = []
-        for j, (x_t, y_t) in enumerate(test_loader):
+        num_samples = len(test_loader.dataset)
+        logits = memmap = metrics = confusion = None
+        offset = 0
+        for x_t, y_t in test_loader:
             x_t, y_t = x_t.to(device), y_t.to(device)
             y_op_test = model(x_t)
-            loss = criterion(y_op_test, y_t)
+            if logits is None:
+                num_classes = y_op_test.shape[1]
+                if logits_path is not None:
+                    memmap = np.lib.format.open_memmap(logits_path, mode='w+', dtype=np.float32,
+                                                       shape=(num_samples, num_classes))
+                    logits = torch.from_numpy(memmap)
+                else:
+                    logits = torch.empty((num_samples, num_classes), dtype=y_op_test.dtype, device=device)
+                metrics = MetricAccumulator(num_classes, device)
+                confusion = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
 
-            test_loss += loss.item()
-            _, y_pred_test = y_op_test.max(1)
-            correct += y_pred_test.eq(y_t).sum()
-            y_logits.append(y_op_test)
+            batch_size = y_t.shape[0]
+            logits[offset:offset + batch_size].copy_(y_op_test)
+            offset += batch_size
+            metrics.update(y_op_test, y_t)
+            if criterion is not None:
+                metrics.add_loss(criterion(y_op_test, y_t), batch_size)
+            confusion.index_add_(0, y_t * num_classes + y_op_test.argmax(dim=1), torch.ones_like(y_t))
 
-        test_accuracy = 100 * correct.float() / len(test_loader.dataset)
-        test_loss = test_loss / j
+        result = metrics.compute()
+        if criterion is None:
+            result['loss'] = None
+        result['confusion'] = confusion.view(num_classes, num_classes).cpu()
+        if memmap is not None:
+            memmap.flush()
+        else:
+            logits = logits.cpu()
 
-        logging.info("Test Accuracy: %.3f, Test Loss: %.3f", 
-            test_accuracy, 
-            test_loss
-        )
-        print("Logits= ",y_logits)
-        return y_logits
+        if criterion is not None:
+            logging.info("Test Accuracy: %.3f, Test Loss: %.3f", result['top1'], result['loss'])
+        logging.info('Top 1 Accuracy = %s; Top 5 Accuracy = %s', result['top1'], result['topk'])
+        logging.info('Per-class Accuracy: %s', ', '.join('%.1f' % a for a in result['class_accuracy']))
+        print(result['top1'], result['topk'])
+        return logits, result
 
-def save_checkpoint(checkpoint, best_path):
+def evaluate_model(model, test_loader, criterion, device):
+    logits, _ = evaluate(model, test_loader, device, criterion)
+    return logits
+
+def save_checkpoint(checkpoint, best_path, writer=None):
         logging.info('Saving model of epoch %s with validation accuracy = %.3f and loss = %.3f',
                      checkpoint['epoch'], checkpoint['validation_accuracy'], checkpoint['validation_loss'])
-        torch.save(checkpoint, best_path)
+        if writer is not None:
+            writer.save(checkpoint, best_path)
+        else:
+            atomic_save(checkpoint, best_path)
 
-def find_model_accuracy(model, test_loader, device):
-    # _, model = load_checkpoint(path, model)
-    with torch.no_grad():
-        model.eval()
+def atomic_save(obj, path):
+    # Readers of path see either the previous or the new file, never a
+    # partially written one
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def snapshot_to_host(obj):
+    '''
+    Copy of a (nested) checkpoint with every tensor cloned to host memory,
+    so training can keep updating the parameters while it is serialized
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_host(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_host(v) for v in obj)
+    return obj
+
+class CheckpointWriter:
+    '''
+    args:
+        max_pending : number of snapshots waiting to be written, save()
+                      blocks when it is reached so host memory stays bounded
+
+    Description:
+        Writes checkpoints on a background thread. save() waits for a free
+        slot, then takes a host snapshot of the checkpoint and returns; the
+        thread serializes it with atomic_save. A pending save is replaced
+        when a newer checkpoint for the same path arrives, so only the latest
+        best model is written. close() waits for the pending saves. An error
+        of the writer thread stops it and is raised by every later save() and
+        by close().
+    '''
+    def __init__(self, max_pending=2):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        # slots held by snapshots that are being taken
+        self.reserved = 0
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
 
-        test_accuracy = torch.empty((0,2))
-        for j, (x_v, y_v) in enumerate(test_loader):
-            x_v, y_v = x_v.to(device), y_v.to(device)
-            y_op_val = model(x_v)
-            res = accuracy(y_op_val, y_v, (1,5))
-            res = torch.FloatTensor(res).reshape(1,2)
-            test_accuracy = torch.cat((test_accuracy, res),0)
-            # loss = criterion(y_op_val, y_v)
-        top1, topk = enumerate(torch.div(torch.sum(test_accuracy, dim=0),test_accuracy.shape[0]))
-        logging.info('Top 1 Accuracy = %s; Top 5 Accuracy = %s', top1[1].item(), topk[1].item())
-        print(top1[1].item(), topk[1].item())
-        return top1[1].item(), topk[1].item()
\ No newline at end of file
+    def save(self, checkpoint, path):
+        with self.cond:
+            self._raise_error()
+            self.cond.wait_for(lambda: len(self.pending) + self.reserved < self.max_pending
+                               or self.error is not None)
+            self._raise_error()
+            self.reserved += 1
+        try:
+            checkpoint = snapshot_to_host(checkpoint)
+        finally:
+            with self.cond:
+                self.reserved -= 1
+        with self.cond:
+            if path in self.pending:
+                logging.info('Dropping the pending checkpoint for %s', path)
+            self.pending[path] = checkpoint
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                path, checkpoint = self.pending.popitem(last=False)
+            try:
+                atomic_save(checkpoint, path)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.pending.clear()
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.cond.notify_all()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self._raise_error()
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def restore_initial_rng(path, resume):
+    '''
+    Saves the RNG state of a fresh run to path, or restores it when resuming,
+    so the labeled split, the validation split and the model initialisation
+    are the same after a restart
+    '''
+    if resume and os.path.exists(path):
+        set_rng_state(torch.load(path, weights_only=False))
+    else:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        atomic_save(rng_state(), path)
+
+def load_resume_state(path, resume):
+    if resume and os.path.exists(path):
+        logging.info('Resuming from %s', path)
+        return torch.load(path, map_location='cpu', weights_only=False)
+    return None
+
+def mark_completed(path, stage):
+    '''
+    Replaces the resumable checkpoint at path by a marker of the last
+    finished stage of the run, 'train' or 'test', so that --resume skips
+    what is done instead of going back to the last periodic checkpoint
+    '''
+    logging.info('Marking %s as complete up to %s', path, stage)
+    atomic_save({'completed': stage}, path)
+
+class PreemptionHandler:
+    '''
+    Turns SIGTERM, which HTCondor sends on eviction, into a flag that the
+    training loop polls after every iteration to write a resumable
+    checkpoint and exit
+    '''
+    def __init__(self):
+        self.requested = False
+        signal.signal(signal.SIGTERM, self._handle)
+
+    def _handle(self, signum, frame):
+        logging.info('Received signal %s, saving a resumable checkpoint', signum)
+        self.requested = True
+
+    def exit(self):
+        sys.exit(128 + signal.SIGTERM)
+
+def find_model_accuracy(model, test_loader, device):
+    _, result = evaluate(model, test_loader, device)
+    return result['top1'], result['topk']
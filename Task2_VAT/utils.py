@@ -1,4 +1,18 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+
+import numpy as np
 import torch
+from torch.autograd.profiler_util import EventList, FunctionEventAvg
+from torch.profiler import ProfilerActivity, profile, schedule
+try:
+    from torch.profiler import _ExperimentalConfig
+except ImportError:
+    # Older releases only expose it in the C extension
+    from torch._C._profiler import _ExperimentalConfig
 
 def accuracy(output, target, topk=(1,)):
     """
@@ -20,3 +34,220 @@ def accuracy(output, target, topk=(1,)):
             correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
             res.append(correct_k.mul_(100.0 / batch_size))
         return res
+
+
+class MetricAccumulator:
+    '''
+    args:
+        num_classes :   number of classes of the per-class counts
+        device      :   device the sums are kept on
+        topk        :   k of the top-k accuracy
+
+    Description:
+        Sums of the loss, the top-1/top-k hits and the per-class hits and
+        counts, kept as tensors on the device. update() only queues device
+        work, so the loop is never stalled by a host sync; compute() reads
+        everything back in one transfer. The loss is averaged over the
+        batches it was added for, or over the samples when the mean loss of
+        a batch is added with its size as weight; the accuracies are averaged
+        over the samples. A mask leaves rows out of the accuracy without
+        indexing the batch.
+    '''
+    def __init__(self, num_classes, device, topk=5):
+        self.num_classes = num_classes
+        self.device = device
+        self.topk = min(topk, num_classes)
+        self.reset()
+
+    def reset(self):
+        # loss, batches, samples, top-1 hits, top-k hits
+        self.sums = torch.zeros(5, dtype=torch.float64, device=self.device)
+        self.class_correct = torch.zeros(self.num_classes, dtype=torch.float64, device=self.device)
+        self.class_total = torch.zeros(self.num_classes, dtype=torch.float64, device=self.device)
+
+    def add_loss(self, loss, weight=1):
+        self.sums[0] += loss.detach() * weight
+        self.sums[1] += weight
+
+    def update(self, output, target, loss=None, mask=None):
+        with torch.no_grad():
+            if loss is not None:
+                self.add_loss(loss)
+            weight = torch.ones_like(target, dtype=torch.float64) if mask is None \
+                else mask.to(torch.float64)
+            _, pred = output.topk(self.topk, 1, True, True)
+            hits = pred.eq(target.view(-1, 1))
+            top1 = hits[:, 0] * weight
+            self.sums[2] += weight.sum()
+            self.sums[3] += top1.sum()
+            self.sums[4] += (hits.any(dim=1) * weight).sum()
+            self.class_correct.index_add_(0, target, top1)
+            self.class_total.index_add_(0, target, weight)
+
+    def compute(self):
+        values = torch.cat((self.sums, self.class_correct, self.class_total)).tolist()
+        loss, batches, count, top1, topk = values[:5]
+        class_correct = values[5:5 + self.num_classes]
+        class_total = values[5 + self.num_classes:]
+        return {
+            'loss': loss / max(batches, 1),
+            'top1': 100 * top1 / max(count, 1),
+            'topk': 100 * topk / max(count, 1),
+            'count': int(count),
+            'class_accuracy': [100 * c / t if t else float('nan')
+                               for c, t in zip(class_correct, class_total)],
+        }
+
+    def state_dict(self):
+        return {'sums': self.sums, 'class_correct': self.class_correct,
+                'class_total': self.class_total}
+
+    def load_state_dict(self, state):
+        self.sums.copy_(state['sums'])
+        self.class_correct.copy_(state['class_correct'])
+        self.class_total.copy_(state['class_total'])
+
+
+
+class StageTimer:
+    '''
+    args:
+        enabled     :   when False every call is a no-op and nothing is stored
+        path        :   file to append one JSON summary per epoch to
+        sync_cuda   :   synchronize the device at the stage boundaries so
+                        asynchronous kernels are attributed to their stage
+
+    Description:
+        Wall-clock timing of the stages of the training loop. mark() sets
+        the reference point and every lap(stage) records the time since the
+        previous mark or lap under that stage, e.g.
+            timer.mark()
+            x, y = next(loader)
+            timer.lap('data_wait')
+            y_pred = model(x)
+            timer.lap('forward')
+        summary() reports the total, mean and p50/p90/p99 of every stage in
+        ms and the throughput in images/s since the previous summary.
+    '''
+    def __init__(self, enabled=False, path=None, sync_cuda=False):
+        self.enabled = enabled
+        self.path = path
+        self.sync_cuda = sync_cuda
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(list)
+        self.images = 0
+        self.start = self.last = time.perf_counter()
+
+    def mark(self):
+        if self.enabled:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            self.last = time.perf_counter()
+
+    def lap(self, stage):
+        if self.enabled:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            now = time.perf_counter()
+            self.times[stage].append(now - self.last)
+            self.last = now
+
+    def add(self, stage, seconds):
+        if self.enabled:
+            self.times[stage].append(seconds)
+
+    def count(self, images):
+        if self.enabled:
+            self.images += images
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        stages = {}
+        for stage, times in self.times.items():
+            ms = 1000 * np.array(times)
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            stages[stage] = {'calls': len(ms), 'total_ms': ms.sum(), 'mean_ms': ms.mean(),
+                             'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99}
+        return {'elapsed_s': elapsed, 'images': self.images,
+                'images_per_s': self.images / elapsed, 'stages': stages}
+
+    def log(self, epoch):
+        '''
+        Logs the summary of the stages recorded since the last call, appends
+        it to path as one JSON line and starts a new interval
+        '''
+        if not self.enabled:
+            return
+        summary = self.summary()
+        logging.info('Epoch %s timing: %.1f images/s', epoch, summary['images_per_s'])
+        for stage, t in summary['stages'].items():
+            logging.info('    %-12s mean %8.2f ms  p50 %8.2f ms  p90 %8.2f ms  p99 %8.2f ms  total %8.1f ms',
+                         stage, t['mean_ms'], t['p50_ms'], t['p90_ms'], t['p99_ms'], t['total_ms'])
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(dict(epoch=epoch, **summary), default=float) + '\n')
+        self.reset()
+
+class _NullProfiler:
+    def start(self):
+        pass
+
+    def step(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def build_profiler(args, name):
+    '''
+    args:
+        args        :   parsed arguments, uses profile, profile_wait,
+                        profile_warmup, profile_active, profile_rows and dataout
+        name        :   prefix of the files written to dataout
+
+    returns :
+        A torch.profiler.profile over the window of iterations given by
+        --profile-wait/--profile-warmup/--profile-active, to be driven with
+        start(), step() once per iteration and stop(). When the window is
+        complete it writes <name>.trace.json (Chrome trace), <name>.stacks.txt
+        (for flame graphs) and <name>.ops.txt (operators by self time, then
+        by total time so the record_function regions show up). Without
+        --profile a no-op object with the same interface is returned.
+    '''
+    if not args.profile:
+        return _NullProfiler()
+    os.makedirs(args.dataout, exist_ok=True)
+    activities = [ProfilerActivity.CPU]
+    metric = stacks_metric = 'self_cpu_time_total'
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+        # The cuda time keys are deprecated in favour of the device ones,
+        # older releases only know the cuda keys
+        metric = stacks_metric = 'self_device_time_total' \
+            if hasattr(FunctionEventAvg(), 'self_device_time_total') else 'self_cuda_time_total'
+        if metric not in EventList().supported_export_stacks_metrics():
+            stacks_metric = 'self_cuda_time_total'
+
+    def on_trace_ready(prof):
+        prefix = os.path.join(args.dataout, name)
+        prof.export_chrome_trace(prefix + '.trace.json')
+        prof.export_stacks(prefix + '.stacks.txt', stacks_metric)
+        with open(prefix + '.ops.txt', 'w') as f:
+            f.write(prof.key_averages(group_by_input_shape=True).table(
+                sort_by=metric, row_limit=args.profile_rows))
+            f.write('\n')
+            f.write(prof.key_averages().table(
+                sort_by=metric.replace('self_', ''), row_limit=args.profile_rows))
+        logging.info('Profile of %s iterations written to %s.*', args.profile_active, prefix)
+
+    return profile(activities=activities,
+                   schedule=schedule(wait=args.profile_wait, warmup=args.profile_warmup,
+                                     active=args.profile_active, repeat=1),
+                   on_trace_ready=on_trace_ready,
+                   record_shapes=True,
+                   with_stack=True,
+                   # Without verbose the stacks file stays empty
+                   experimental_config=_ExperimentalConfig(verbose=True))
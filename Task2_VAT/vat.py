@@ -1,13 +1,70 @@
 
+import os
+from contextlib import contextmanager
+
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.profiler import record_function
 
 def l2_norm(c):
     c_reshape = c.view(c.shape[0], -1, *(1 for _ in range(c.dim() - 2)))
     c /= torch.norm(c_reshape, dim=1, keepdim=True) + 1e-8
     return c
 
+@contextmanager
+def freeze_bn_stats(model):
+    '''
+    Forwards inside the block normalise with the batch statistics as usual
+    in train mode, but leave the BatchNorm running mean/var untouched.
+    '''
+    bns = [m for m in model.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    for m in bns:
+        m.track_running_stats = False
+    try:
+        yield
+    finally:
+        for m in bns:
+            m.track_running_stats = True
+
+class PerturbationCache:
+    '''
+    args:
+        path            :   file of the float16 memory-mapped array, reused
+                            when it already has the right shape
+        num_samples     :   size of the unlabeled dataset
+        shape           :   shape of one sample, e.g. (3, 32, 32)
+
+    Description:
+        Stores the last adversarial direction of every unlabeled sample,
+        keyed by its index in the unlabeled dataset. Rows that were never
+        written are all zero and fall back to a random direction.
+    '''
+    def __init__(self, path, num_samples, shape):
+        shape = (num_samples, *shape)
+        mode = 'w+'
+        if os.path.exists(path) and \
+                os.path.getsize(path) == np.prod(shape) * np.dtype(np.float16).itemsize:
+            mode = 'r+'
+        self.directions = np.memmap(path, dtype=np.float16, mode=mode, shape=shape)
+
+    def get(self, index, x):
+        index = index.cpu().numpy()
+        r = torch.from_numpy(self.directions[index]).to(x.device, x.dtype)
+        cold = r.flatten(1).abs().sum(dim=1) == 0
+        if cold.any():
+            r[cold] = torch.randn_like(r[cold])
+        return r
+
+    def put(self, index, r):
+        self.directions[index.cpu().numpy()] = r.detach().cpu().half().numpy()
+
+    def flush(self):
+        self.directions.flush()
+
+
 class VATLoss(nn.Module):
 
     def __init__(self, args):
@@ -15,26 +72,41 @@ class VATLoss(nn.Module):
         self.xi = args.vat_xi
         self.eps = args.vat_eps
         self.vat_iter = args.vat_iter
+        self.cache = None
 
-    def forward(self, model, x):
-        
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        r = torch.randn(x.shape).to(device)
-        r = l2_norm(r)
-        pred = F.softmax(model(x), dim=1)
+    def forward(self, model, x, index=None, logits=None):
         
-        for num in range(self.vat_iter):
-            r.requires_grad_(True)
-            advEx = x + self.xi*r
-            advPred = F.softmax(model(advEx), dim=1)
-            adv_dist = F.kl_div(pred, advPred)
-            adv_dist.backward(retain_graph=True)
-            d = r.grad
-            model.zero_grad()
-        
-        r_adv = l2_norm(d) * self.eps
-        adv_pred = F.softmax(model(x + r_adv), dim=1)
-        loss = F.kl_div(pred, adv_pred)
-        return loss    
+        # The clean prediction is treated as a constant target, it can be
+        # passed in when it comes from a shared forward with the labeled batch
+        with record_function('vat_clean_prediction'):
+            if logits is not None:
+                pred = F.softmax(logits.detach(), dim=1)
+            else:
+                with torch.no_grad():
+                    pred = F.softmax(model(x), dim=1)
+
+        with record_function('vat_power_iteration'):
+            # Warm start from the direction found for these samples last time
+            if self.cache is not None and index is not None:
+                r = self.cache.get(index, x)
+            else:
+                r = torch.randn_like(x)
+            r = l2_norm(r)
             
-        raise NotImplementedError
\ No newline at end of file
+            # Power iteration, only the gradient w.r.t. the perturbation is
+            # computed so the model parameters' .grad stay untouched
+            for num in range(self.vat_iter):
+                r.requires_grad_(True)
+                advEx = x + self.xi*r
+                advPred = F.softmax(model(advEx), dim=1)
+                adv_dist = F.kl_div(pred, advPred)
+                d, = torch.autograd.grad(adv_dist, r)
+                r = l2_norm(d)
+            if self.cache is not None and index is not None:
+                self.cache.put(index, r)
+        
+        with record_function('vat_adversarial_loss'):
+            r_adv = r * self.eps
+            adv_pred = F.softmax(model(x + r_adv), dim=1)
+            loss = F.kl_div(pred, adv_pred)
+        return loss
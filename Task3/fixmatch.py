@@ -0,0 +1,79 @@
+import torch
+import torch.nn.functional as F
+from torch.profiler import record_function
+
+from utils import StageTimer
+
+
+def fixmatch_step(model, optimizer, x_l, y_l, x_ul_w, x_ul_s, threshold, lambda_u,
+                  micro_batch=0, metrics=None, timer=None):
+    '''
+    args:
+        x_l, y_l        :   labeled batch
+        x_ul_w, x_ul_s  :   weak and strong view of the unlabeled batch
+        threshold       :   confidence the weak-view prediction needs to be
+                            used as a pseudo-label
+        lambda_u        :   weight of the unsupervised loss
+        micro_batch     :   images per forward, the gradients are
+                            accumulated over the micro-batches (0 = one
+                            forward for the whole batch)
+        metrics         :   (optional) MetricAccumulator of the supervised
+                            accuracy and the loss
+        timer           :   (optional) StageTimer of the training loop
+    returns : (torch.Tensor) the loss of the step, not read back to the host
+
+    Description:
+        One training step of the modified FixMatch: pseudo-labels from the
+        weak view without autograd, then the supervised loss plus lambda_u
+        times the unsupervised loss on the strong view, backward and an
+        optimizer step.
+    '''
+    timer = timer or StageTimer()
+    device = x_l.device
+    count_l = x_l.shape[0]
+    count_ul = x_ul_s.shape[0]
+    # Forwards run on chunks of at most micro_batch images so the
+    # activation memory stays bounded for large mu
+    chunk = micro_batch or (count_l + count_ul)
+
+    # The weak view only provides the pseudo-label targets
+    with torch.no_grad():
+        y_ul_w_pred = torch.cat([model(x) for x in x_ul_w.split(chunk)])
+    with record_function('pseudo_label_select'):
+        y_pseudolabel_prob, y_pseudolabel_class = torch.max(y_ul_w_pred, axis=1)
+        y_pseudolabel_prob = torch.where(y_pseudolabel_prob >= threshold, 1.0, 0.0)
+    timer.lap('pseudo_label')
+
+    # Supervised loss (mean over x_l) plus lambda_u times the
+    # unsupervised loss (mean over x_ul_s, scaled by the fraction of
+    # confident pseudo-labels) written as per-sample weights, so the
+    # gradients of the micro-batches add up to the full-batch one
+    X = torch.cat((x_l, x_ul_s))
+    Y = torch.cat((y_l, y_pseudolabel_class))
+    is_strong = torch.arange(count_l + count_ul, device=device) >= count_l
+    weight = torch.where(is_strong,
+                         lambda_u * y_pseudolabel_prob.mean() / count_ul,
+                         torch.tensor(1.0 / count_l, device=device))
+
+    optimizer.zero_grad()
+    loss = 0.0
+    for start in range(0, count_l + count_ul, chunk):
+        rows = slice(start, start + chunk)
+        y_pred = model(X[rows])
+        strong = is_strong[rows].unsqueeze(1)
+        y_pred = torch.where(strong, torch.softmax(y_pred, dim=-1), y_pred)
+        chunk_loss = (F.cross_entropy(y_pred, Y[rows], reduction='none') * weight[rows]).sum()
+        timer.lap('forward')
+        chunk_loss.backward()
+        timer.lap('backward')
+        loss += chunk_loss.detach()
+
+        # Compute Accuracy of supervised training
+        if metrics is not None:
+            metrics.update(y_pred, Y[rows], mask=~strong.squeeze(1))
+
+    optimizer.step()
+    if metrics is not None:
+        metrics.add_loss(loss)
+    timer.lap('optimizer')
+    return loss
@@ -6,17 +6,18 @@ import os
 import logging
 import random
 
-from dataloader import get_cifar10, get_cifar100
-from utils import accuracy
-from test import test_cifar10, test_cifar100, load_checkpoint, save_checkpoint, find_model_accuracy
+from dataloader import get_cifar10, get_cifar100, InfiniteDataLoader, Prefetcher, TensorEvalLoader, val_test_split, worker_memory, num_expanded_labels
+from utils import accuracy, StageTimer, MetricAccumulator, build_profiler
+from test import test_cifar10, test_cifar100, load_checkpoint, save_checkpoint, CheckpointWriter, find_model_accuracy, \
+    rng_state, set_rng_state, restore_initial_rng, load_resume_state, mark_completed, PreemptionHandler
 
 from model.wrn import WideResNet
+from fixmatch import fixmatch_step
 
 import torch
 import torch.optim as optim
 import torch.nn as nn
 from torch.utils.data import DataLoader
-from torch.utils.data import random_split
 
 curr_path = os.path.dirname(os.path.abspath(__file__))
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(message)s',
@@ -24,6 +25,16 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(
 
 
 def main(args):
+    resume_path = os.path.join(args.dataout, 'resume.task3.pt')
+    restore_initial_rng(os.path.join(args.dataout, 'resume.task3.rng.pt'), args.resume)
+    resume = load_resume_state(resume_path, args.resume)
+    if resume is not None and resume.get('completed') == 'test':
+        logging.info('Nothing to resume, the run is complete')
+        return
+    if args.synthetic:
+        # Generated CIFAR-format data of its own root, read through the cache
+        args.datapath = os.path.join(args.datapath, 'synthetic-{}'.format(args.synthetic))
+        args.data_cache = True
     if args.dataset == "cifar10":
         args.num_classes = 10
         labeled_dataset, unlabeled_dataset, test_dataset = get_cifar10(args,
@@ -37,26 +48,42 @@ def main(args):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     val_size = 1000
-    test_size = len(test_dataset) - val_size
-    test_dataset, val_dataset = random_split(test_dataset, [test_size, val_size])
-
-    labeled_loader = iter(DataLoader(labeled_dataset,
-                                     batch_size=args.train_batch,
-                                     shuffle=True,
-                                     num_workers=args.num_workers))
-    unlabeled_loader = iter(DataLoader(unlabeled_dataset,
-                                       batch_size=args.train_batch,
-                                       shuffle=True,
-                                       num_workers=args.num_workers))
+    test_dataset, val_dataset = val_test_split(args, args.datapath, test_dataset, val_size)
+
+    labeled_loader = InfiniteDataLoader(labeled_dataset,
+                                        batch_size=args.train_batch,
+                                        num_workers=args.num_workers,
+                                        num_samples=num_expanded_labels(args),
+                                        pin_memory=device.type == 'cuda')
+    unlabeled_loader = InfiniteDataLoader(unlabeled_dataset,
+                                          batch_size=args.mu * args.train_batch,
+                                          num_workers=args.num_workers,
+                                          pin_memory=device.type == 'cuda')
     test_loader = DataLoader(test_dataset,
                              batch_size=args.test_batch,
                              shuffle=False,
-                             num_workers=args.num_workers)
+                             num_workers=args.num_workers,
+                             pin_memory=device.type == 'cuda')
         
     val_loader = DataLoader(val_dataset,
                              batch_size=args.test_batch,
                              shuffle=False,
+                             num_workers=args.num_workers,
+                             pin_memory=device.type == 'cuda')
+
+    # Stage the batches on the device ahead of the loop
+    labeled_loader, unlabeled_loader, test_loader, val_loader = [
+        Prefetcher(loader, device, args.prefetch, time_copies=args.timing) for loader in
+        (labeled_loader, unlabeled_loader, test_loader, val_loader)]
+
+    if args.eval_data == 'memory':
+        # The validation and test images are decoded and normalized once
+        test_loader, val_loader = [
+            TensorEvalLoader(dataset, args.test_batch, device,
+                             dtype=getattr(torch, args.eval_dtype),
+                             channels_last=args.eval_channels_last,
                              num_workers=args.num_workers)
+            for dataset in (test_dataset, val_dataset)]
 
     model = WideResNet(args.model_depth,
                        args.num_classes, widen_factor=args.model_width, dropRate=0.25)
@@ -69,6 +96,8 @@ def main(args):
     torch.save(model.state_dict(), init_path)
 
     criterion = nn.CrossEntropyLoss()
+    timer = StageTimer(args.timing, os.path.join(curr_path, 'out.task3.timing.jsonl'),
+                       sync_cuda=args.timing and device.type == 'cuda')
 
     # Code to evaluate the best model
    
@@ -94,102 +123,112 @@ def main(args):
 
     best_path = os.path.join(
         curr_path, 'best_model.pt')
+    checkpoint_writer = CheckpointWriter()
     loss_list = []
-    for epoch in range(args.epoch):
+    train_metrics = MetricAccumulator(args.num_classes, device)
+    val_metrics = MetricAccumulator(args.num_classes, device)
+
+    preemption = PreemptionHandler()
+
+    def resume_state(epoch, iteration):
+        return {
+            'epoch': epoch,
+            'iteration': iteration,
+            'state_dict': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'labeled_loader': labeled_loader.state_dict(),
+            'unlabeled_loader': unlabeled_loader.state_dict(),
+            'rng': rng_state(),
+            'threshold': threshold,
+            'lambda_u': lambda_u,
+            'best_loss': best_loss,
+            'loss_list': loss_list,
+            'train_metrics': train_metrics.state_dict(),
+        }
+
+    start_epoch = 0
+    if resume is not None and resume.get('completed') == 'train':
+        # Only the evaluation of the best model is left
+        resume, start_epoch = None, args.epoch
+    if resume is not None:
+        model.load_state_dict(resume['state_dict'])
+        optimizer.load_state_dict(resume['optimizer'])
+        scheduler.load_state_dict(resume['scheduler'])
+        labeled_loader.load_state_dict(resume['labeled_loader'])
+        unlabeled_loader.load_state_dict(resume['unlabeled_loader'])
+        set_rng_state(resume['rng'])
+        threshold, lambda_u = resume['threshold'], resume['lambda_u']
+        best_loss, loss_list = resume['best_loss'], resume['loss_list']
+        start_epoch = resume['epoch']
+
+    profiler = build_profiler(args, 'task3')
+    profiler.start()
+    for epoch in range(start_epoch, args.epoch):
         model.train()
         x_pseudo_set = []
         y_pseudo_set = []
-        correct = 0
-        total = 0
-        running_loss = 0.0
-
-        for i in range(args.iter_per_epoch):
-            try:
-                # labeled data
-                x_l, y_l = next(labeled_loader)
-            except StopIteration:
-                labeled_loader = iter(DataLoader(labeled_dataset,
-                                                    batch_size=args.train_batch,
-                                                    shuffle=True,
-                                                    num_workers=args.num_workers))
-                x_l, y_l = next(labeled_loader)
-
-            try:
-                # unlabeled data
-                x_ul_w, x_ul_s, _ = next(unlabeled_loader)
-            except StopIteration:
-                unlabeled_loader = iter(DataLoader(unlabeled_dataset,
-                                                    batch_size=args.train_batch,
-                                                    shuffle=True,
-                                                    num_workers=args.num_workers))
-                x_ul_w, x_ul_s, _ = next(unlabeled_loader)
-
-            x_l, y_l, x_ul_w, x_ul_s = x_l.to(device), y_l.to(
-                device), x_ul_w.to(device), x_ul_s.to(device)
-            
-            # Train all data on the model
-            count_l = x_l.shape[0]
-            count_ul_w = x_ul_w.shape[0]
-            count_ul_s = x_ul_s.shape[0]
-
-            X = torch.cat((x_l, x_ul_w, x_ul_s))
-
-            Y = model(X)
-
-            y_l_pred, y_ul_w_pred, y_ul_s_pred = torch.split(Y, [count_l, count_ul_w, count_ul_s])
-
-            # Compute Accuracy of supervised training
-            correct += (torch.argmax(y_l_pred, axis=1)
-                        == y_l).float().sum()
-            total += float(x_l.size(dim=0))
-
-            # Supervised Loss
-            loss_s = criterion(y_l_pred, y_l)
-
-            # Unsupervised Loss
-            y_pseudolabel_prob, y_pseudolabel_class = torch.max(y_ul_w_pred, axis=1)
-            y_pseudolabel_prob = torch.where(y_pseudolabel_prob >= threshold, 1.0, 0.0)
-            y_strong_pred = torch.softmax(y_ul_s_pred, dim=-1)
-            loss_u = (criterion(y_strong_pred, y_pseudolabel_class) * y_pseudolabel_prob).mean()
-
-            # Overall Loss
-            loss = (loss_s + lambda_u * loss_u)
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item()
+        train_metrics.reset()
+        first_iter = 0
+        if resume is not None:
+            # Continue the interrupted epoch
+            first_iter = resume['iteration']
+            train_metrics.load_state_dict(resume['train_metrics'])
+            resume = None
+
+        for i in range(first_iter, args.iter_per_epoch):
+            timer.mark()
+            # labeled data
+            x_l, y_l = next(labeled_loader)
+
+            # unlabeled data
+            x_ul_w, x_ul_s, _ = next(unlabeled_loader)
+            timer.lap('data_wait')
+            timer.add('h2d_copy', labeled_loader.copy_time + unlabeled_loader.copy_time)
+
+            fixmatch_step(model, optimizer, x_l, y_l, x_ul_w, x_ul_s, threshold, lambda_u,
+                          micro_batch=args.micro_batch, metrics=train_metrics, timer=timer)
+            timer.count(x_l.shape[0] + x_ul_s.shape[0])
+            profiler.step()
+
+            if preemption.requested:
+                checkpoint_writer.save(resume_state(epoch, i + 1), resume_path)
+                checkpoint_writer.close()
+                preemption.exit()
+            if args.checkpoint_every and (epoch * args.iter_per_epoch + i + 1) % args.checkpoint_every == 0:
+                checkpoint_writer.save(resume_state(epoch, i + 1), resume_path)
 
             # End of batch
 
-        accuracy_train = 100 * correct / total
-        running_loss /= args.iter_per_epoch
+        logging.info('Epoch %s/%s, Data wait: %.2f ms/iteration',
+                     epoch+1, args.epoch,
+                     1000 * (labeled_loader.reset_wait_time()
+                             + unlabeled_loader.reset_wait_time()) / args.iter_per_epoch)
+
+        train_result = train_metrics.compute()
+        accuracy_train, running_loss = train_result['top1'], train_result['loss']
         loss_list.append(running_loss)
 
         if epoch % 10:
             threshold += threshold_int
             lambda_u += lambda_int
 
+        timer.mark()
         with torch.no_grad():
             model.eval()
-            test_loss = 0.0
-            correct = 0.0
-            for j, (x_v, y_v) in enumerate(val_loader):
-                x_v, y_v = x_v.to(device), y_v.to(device)
+            val_metrics.reset()
+            for x_v, y_v in val_loader:
                 y_op_val = model(x_v)
-                loss = criterion(y_op_val, y_v)
+                val_metrics.update(y_op_val, y_v, criterion(y_op_val, y_v))
 
-                test_loss += loss.item()
-                _, y_pred_test = y_op_val.max(1)
-                correct += y_pred_test.eq(y_v).sum()
-
-            test_accuracy = 100 * correct.float() / len(val_loader.dataset)
-            test_loss = test_loss / j
+            val_result = val_metrics.compute()
+            test_accuracy, test_loss = val_result['top1'], val_result['loss']
+            timer.lap('validation')
 
             logging.info("Epoch %s/%s, Train Accuracy: %.3f, Test Accuracy: %.3f, Training Loss: %.3f, Test Loss: %.3f",
                 epoch+1,
                 args.epoch,
-                accuracy_train.item(),
+                accuracy_train,
                 test_accuracy,
                 running_loss,
                 test_loss
@@ -204,23 +243,34 @@ def main(args):
                     'validation_accuracy': test_accuracy,
                     'state_dict': model.state_dict(),
                 }
-                save_checkpoint(checkpoint, best_path)
+                save_checkpoint(checkpoint, best_path, checkpoint_writer)
+        timer.log(epoch+1)
+        if args.report_memory:
+            for usage in worker_memory():
+                logging.info('Worker %s: RSS = %.1f MB, anonymous = %.1f MB, shared = %.1f MB',
+                             usage['pid'], usage['rss'], usage['anon'], usage['shared'])
+
         scheduler.step(test_loss)
         print("Epoch {}/{}, Train Accuracy: {:.3f}, Test Accuracy: {:.3f}, Training Loss: {:.3f}, Test Loss: {:.3f}".format(
                 epoch+1,
                 args.epoch,
-                accuracy_train.item(),
+                accuracy_train,
                 test_accuracy,
                 running_loss,
                 test_loss
             ))
 
+    profiler.stop()
+    # The best checkpoint has to be on disk before it is evaluated
+    checkpoint_writer.close()
+    mark_completed(resume_path, 'train')
     logging.info('Training Complete...')
 
     if args.dataset == "cifar10":
         test_cifar10(args, device, test_loader, best_path)
     elif args.dataset == "cifar100":
         test_cifar100(args, device, test_loader, best_path)
+    mark_completed(resume_path, 'test')
 
 
 if __name__ == "__main__":
@@ -232,6 +282,9 @@ if __name__ == "__main__":
                         type=str, choices=["cifar10", "cifar100"])
     parser.add_argument("--datapath", default="./data/",
                         type=str, help="Path to the CIFAR-10/100 dataset")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="seed of the labeled/unlabeled and validation/test splits, the splits "
+                             "are drawn once per seed and cached under <datapath>/splits")
     parser.add_argument('--num-labeled', type=int,
                         default=4000, help='Total number of labeled samples')
 
@@ -244,6 +297,32 @@ if __name__ == "__main__":
                         help="Weight decay")
     parser.add_argument("--expand-labels", action="store_true",
                         help="expand labels to fit eval steps")
+    parser.add_argument("--batch-augment", action="store_true",
+                        help="apply the weak augmentation to whole collated batches instead of per sample")
+    parser.add_argument("--strong-augment", default="per-sample", type=str,
+                        choices=["per-sample", "batch"],
+                        help="'batch' applies RandAugment to whole uint8 batches grouped by op "
+                             "(implies the batched weak augmentation)")
+    parser.add_argument("--synthetic", default=0, type=int,
+                        help="train on this many generated CIFAR-format images written to "
+                             "<datapath>/synthetic-N instead of the real dataset, needs no "
+                             "download (implies --data-cache)")
+    parser.add_argument("--data-cache", action="store_true",
+                        help="convert CIFAR once into .npy files under the datapath and memory-map them")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="move the dataset arrays to shared memory before the workers start")
+    parser.add_argument("--report-memory", action="store_true",
+                        help="log the resident memory of every DataLoader worker after each epoch")
+    parser.add_argument("--eval-data", default="loader", type=str, choices=["loader", "memory"],
+                        help="'memory' keeps the normalized validation and test images on the device "
+                             "and evaluates without DataLoader workers")
+    parser.add_argument("--eval-dtype", default="float32", type=str, choices=["float32", "float16"],
+                        help="storage type of the images with --eval-data memory")
+    parser.add_argument("--eval-channels-last", action="store_true",
+                        help="store the images channels_last with --eval-data memory")
+    parser.add_argument("--save-logits", action="store_true",
+                        help="write the test logits of the best model next to its checkpoint "
+                             "as a memory-mapped .npy file")
 
     # Training Configuration
     parser.add_argument('--train-batch', default=64, type=int,
@@ -254,6 +333,30 @@ if __name__ == "__main__":
                         help='total number of iterations to run')
     parser.add_argument('--iter-per-epoch', default=1024, type=int,
                         help="Number of iterations to run per epoch")
+    parser.add_argument('--mu', default=1, type=int,
+                        help='ratio of unlabeled to labeled images per batch (7 in FixMatch)')
+    parser.add_argument('--micro-batch', default=0, type=int,
+                        help='images per forward, gradients are accumulated over the micro-batches '
+                             '(0 = one forward for the whole batch)')
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the resumable checkpoint in --dataout if there is one")
+    parser.add_argument("--checkpoint-every", default=200, type=int,
+                        help="iterations between resumable checkpoints (0 = only on SIGTERM)")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile a window of training iterations with torch.profiler, "
+                             "the Chrome trace, stacks and operator table are written to --dataout")
+    parser.add_argument("--profile-wait", default=5, type=int,
+                        help="iterations to skip before the profiler warms up")
+    parser.add_argument("--profile-warmup", default=2, type=int,
+                        help="profiler warm-up iterations, recorded but discarded")
+    parser.add_argument("--profile-active", default=5, type=int,
+                        help="iterations recorded by the profiler")
+    parser.add_argument("--profile-rows", default=30, type=int,
+                        help="rows of the operator table")
+    parser.add_argument("--timing", action="store_true",
+                        help="record per-stage timings of the training loop, logged per epoch and appended to out.task3*.timing.jsonl")
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help="Number of batches staged on the device ahead of the training loop (0 = synchronous)")
     parser.add_argument('--num-workers', default=1, type=int,
                         help="Number of workers to launch during training")
 
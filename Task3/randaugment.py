@@ -0,0 +1,85 @@
+import math
+
+import torch
+import torchvision.transforms.functional as F
+
+
+def _affine(x, translate=(0, 0), shear=(0.0, 0.0), center=None):
+    return F.affine(x, angle=0.0, translate=list(translate), scale=1.0,
+                    shear=list(shear), center=center)
+
+
+def _shear(magnitude):
+    return math.degrees(math.atan(magnitude))
+
+
+# op_name: (apply(x, magnitude), magnitudes over the bins, signed). The
+# magnitudes follow torchvision's RandAugment for 32x32 images
+def augmentation_space(num_bins, image_size=(32, 32)):
+    h, w = image_size
+    return {
+        'Identity': (lambda x, m: x, torch.tensor(0.0), False),
+        'ShearX': (lambda x, m: _affine(x, shear=(_shear(m), 0.0), center=[0, 0]),
+                   torch.linspace(0.0, 0.3, num_bins), True),
+        'ShearY': (lambda x, m: _affine(x, shear=(0.0, _shear(m)), center=[0, 0]),
+                   torch.linspace(0.0, 0.3, num_bins), True),
+        'TranslateX': (lambda x, m: _affine(x, translate=(int(m), 0)),
+                       torch.linspace(0.0, 150.0 / 331.0 * w, num_bins), True),
+        'TranslateY': (lambda x, m: _affine(x, translate=(0, int(m))),
+                       torch.linspace(0.0, 150.0 / 331.0 * h, num_bins), True),
+        'Rotate': (lambda x, m: F.rotate(x, m),
+                   torch.linspace(0.0, 30.0, num_bins), True),
+        'Brightness': (lambda x, m: F.adjust_brightness(x, 1.0 + m),
+                       torch.linspace(0.0, 0.9, num_bins), True),
+        'Color': (lambda x, m: F.adjust_saturation(x, 1.0 + m),
+                  torch.linspace(0.0, 0.9, num_bins), True),
+        'Contrast': (lambda x, m: F.adjust_contrast(x, 1.0 + m),
+                     torch.linspace(0.0, 0.9, num_bins), True),
+        'Sharpness': (lambda x, m: F.adjust_sharpness(x, 1.0 + m),
+                      torch.linspace(0.0, 0.9, num_bins), True),
+        'Posterize': (lambda x, m: F.posterize(x, int(m)),
+                      8 - (torch.arange(num_bins) / ((num_bins - 1) / 4)).round().int(), False),
+        'Solarize': (lambda x, m: F.solarize(x, m),
+                     torch.linspace(255.0, 0.0, num_bins), False),
+        'AutoContrast': (lambda x, m: F.autocontrast(x), torch.tensor(0.0), False),
+        'Equalize': (lambda x, m: F.equalize(x), torch.tensor(0.0), False),
+    }
+
+
+class BatchRandAugment:
+    '''
+    args:
+        num_ops             :   number of ops applied to every image
+        magnitude           :   magnitude bin shared by all ops
+        num_magnitude_bins  :   number of magnitude bins
+
+    Description:
+        RandAugment on a whole uint8 batch of shape [B, C, H, W] on any
+        device. Every image draws its own op and sign as in
+        transforms.RandAugment, then the batch is grouped by (op, sign) so
+        every op runs once on the sub-batch that drew it instead of once per
+        image. The output stays uint8, normalization is left to the caller.
+    '''
+    def __init__(self, num_ops=1, magnitude=2, num_magnitude_bins=31):
+        self.num_ops = num_ops
+        self.ops = []
+        for op, magnitudes, signed in augmentation_space(num_magnitude_bins).values():
+            m = float(magnitudes[magnitude]) if magnitudes.ndim > 0 else 0.0
+            self.ops.append((op, m, signed))
+        self.signed = torch.tensor([signed for _, _, signed in self.ops]).long()
+
+    def __call__(self, x):
+        b = x.shape[0]
+        for _ in range(self.num_ops):
+            op_index = torch.randint(len(self.ops), (b,))
+            # The sign only splits the groups of signed ops
+            sign = torch.randint(2, (b,)) * self.signed[op_index]
+            keys = op_index * 2 + sign
+            x = x.clone()
+            for key in torch.unique(keys).tolist():
+                op, m, signed = self.ops[key // 2]
+                if key % 2:
+                    m = -m
+                idx = (keys == key).nonzero().squeeze(1).to(x.device)
+                x[idx] = op(x[idx], m)
+        return x
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import warnings
+from datetime import datetime, timezone
+
+import numpy as np
+import torch
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TASK1 = 'Task1_pseudoLabeling'
+TASK2 = 'Task2_VAT'
+TASK3 = 'Task3'
+
+
+def _enter_task(task):
+    # The tasks are standalone directories with the same module names
+    # (dataloader, utils, test, model.wrn), every case runs in a fresh
+    # process with its own task directory first on the path
+    sys.path.insert(0, os.path.join(repo_path, task))
+    warnings.filterwarnings('ignore')
+
+
+def _child(conn, task, function, params, opts):
+    _enter_task(task)
+    try:
+        conn.send(function(params, opts))
+    except Exception as e:
+        conn.send(RuntimeError('{}: {!r}'.format(function.__name__, e)))
+    conn.close()
+
+
+def run_case(context, task, function, params, opts):
+    '''
+    Runs function(params, opts) in a fresh spawned process and returns its
+    result. The process is not a daemon (unlike a Pool worker) so the case
+    can start DataLoader workers of its own.
+    '''
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=_child, args=(child_conn, task, function, params, opts))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        result = RuntimeError('{} exited with code {}'.format(function.__name__, process.exitcode))
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def _device():
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def _time(step, steps, warmup, device):
+    '''
+    returns : (list) wall-clock seconds of every timed call of step(), the
+              device is synchronized around each call
+    '''
+    for _ in range(warmup):
+        step()
+    times = []
+    for _ in range(steps):
+        _sync(device)
+        start = time.perf_counter()
+        step()
+        _sync(device)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _data_args(opts, **kwargs):
+    # The options the dataset builders of all three tasks read
+    args = argparse.Namespace(
+        dataset='cifar10', num_classes=10, num_labeled=opts.num_labeled,
+        seed=0, data_cache=True, synthetic=opts.synthetic,
+        shared_memory=False, batch_augment=False, strong_augment='per-sample',
+        expand_labels=False, iter_per_epoch=1024, train_batch=opts.batch,
+        vat_cache=None)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def _data_root(opts):
+    return os.path.join(opts.datapath, 'synthetic-{}'.format(opts.synthetic))
+
+
+def _model(config, device, num_classes=10):
+    from model.wrn import WideResNet
+    depth, width = (int(v) for v in config.split('-'))
+    torch.manual_seed(0)
+    return WideResNet(depth, num_classes, widen_factor=width).to(device)
+
+
+def bench_getitem(params, opts):
+    '''CIFAR10SSL.__getitem__ of the Task3 unlabeled set (weak and strong view).'''
+    from dataloader import get_cifar10
+    _, dataset, _ = get_cifar10(_data_args(opts), _data_root(opts))
+    rng = np.random.RandomState(0)
+
+    def step():
+        for index in rng.randint(len(dataset), size=opts.batch):
+            dataset[index]
+    return _time(step, opts.steps, opts.warmup, torch.device('cpu')), opts.batch
+
+
+def bench_loader(params, opts):
+    '''Batches of the Task3 unlabeled InfiniteDataLoader, per-sample transforms.'''
+    from dataloader import get_cifar10, InfiniteDataLoader
+    _, dataset, _ = get_cifar10(_data_args(opts), _data_root(opts))
+    loader = InfiniteDataLoader(dataset, batch_size=opts.batch,
+                                num_workers=params['num_workers'], seed=0)
+    # The first batches include the worker start-up
+    times = _time(lambda: next(loader), opts.steps, opts.warmup + params['num_workers'],
+                  torch.device('cpu'))
+    return times, opts.batch
+
+
+def bench_wrn(params, opts):
+    '''WideResNet forward, or forward and backward, in train mode.'''
+    device = _device()
+    model = _model(params['model'], device)
+    model.train()
+    x = torch.randn(opts.batch, 3, 32, 32, device=device)
+    y = torch.randint(10, (opts.batch,), device=device)
+
+    def forward():
+        with torch.no_grad():
+            model(x)
+
+    def forward_backward():
+        loss = torch.nn.functional.cross_entropy(model(x), y)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+    step = forward if params['pass'] == 'forward' else forward_backward
+    return _time(step, opts.steps, opts.warmup, device), opts.batch
+
+
+def bench_vat(params, opts):
+    '''VATLoss forward and backward on an unlabeled batch.'''
+    from vat import VATLoss
+    device = _device()
+    model = _model(opts.model, device)
+    model.train()
+    vat = VATLoss(argparse.Namespace(vat_xi=10.0, vat_eps=1.0, vat_iter=params['vat_iter']))
+    x = torch.randn(opts.batch, 3, 32, 32, device=device)
+
+    def step():
+        vat(model, x).backward()
+        model.zero_grad(set_to_none=True)
+    return _time(step, opts.steps, opts.warmup, device), opts.batch
+
+
+def bench_pseudo_label(params, opts):
+    '''PseudoLabelBuffer selection of the Task1 loop and the next training input.'''
+    from pseudo_label import PseudoLabelBuffer
+    device = _device()
+    buffer = PseudoLabelBuffer(opts.batch)
+    x_l = torch.randn(opts.batch, 3, 32, 32, device=device)
+    y_l = torch.randint(10, (opts.batch,), device=device)
+    x_ul = torch.randn(opts.batch, 3, 32, 32, device=device)
+    y_pred = torch.softmax(torch.randn(opts.batch, 10, device=device) * 3, dim=1)
+
+    def step():
+        buffer.update(x_ul, y_pred, params['threshold'])
+        buffer.batch(x_l, y_l)
+    return _time(step, opts.steps * 10, opts.warmup, device), opts.batch
+
+
+def bench_fixmatch(params, opts):
+    '''One Task3 fixmatch_step on device-resident batches.'''
+    from fixmatch import fixmatch_step
+    device = _device()
+    model = _model(opts.model, device)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9, weight_decay=5e-5)
+    count_l, count_ul = opts.batch, params['mu'] * opts.batch
+    x_l = torch.randn(count_l, 3, 32, 32, device=device)
+    y_l = torch.randint(10, (count_l,), device=device)
+    x_ul_w = torch.randn(count_ul, 3, 32, 32, device=device)
+    x_ul_s = torch.randn(count_ul, 3, 32, 32, device=device)
+
+    def step():
+        fixmatch_step(model, optimizer, x_l, y_l, x_ul_w, x_ul_s, threshold=0.95, lambda_u=0.5)
+    return _time(step, opts.steps, opts.warmup, device), count_l + count_ul
+
+
+def bench_evaluate(params, opts):
+    '''evaluate_model over a slice of the test set.'''
+    from torch.utils.data import DataLoader, Subset
+    from dataloader import get_cifar10, Prefetcher, TensorEvalLoader
+    from test import evaluate_model
+    device = _device()
+    _, _, test_dataset = get_cifar10(_data_args(opts), _data_root(opts))
+    test_dataset = Subset(test_dataset, range(min(opts.eval_samples, len(test_dataset))))
+    if params['eval_data'] == 'memory':
+        loader = TensorEvalLoader(test_dataset, opts.batch, device)
+    else:
+        loader = Prefetcher(DataLoader(test_dataset, batch_size=opts.batch, shuffle=False,
+                                       num_workers=opts.eval_workers), device)
+    model = _model(opts.model, device)
+    criterion = torch.nn.CrossEntropyLoss()
+
+    def step():
+        # evaluate_model reports its accuracy on stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            evaluate_model(model, loader, criterion, device)
+    return _time(step, max(1, opts.steps // 5), 1, device), len(test_dataset)
+
+
+# name: (task directory, function, parameter grid, unit of the result)
+def benchmark_cases(opts):
+    return {
+        'getitem': (TASK3, bench_getitem, [{}], 'samples/s'),
+        'loader': (TASK3, bench_loader,
+                   [{'num_workers': n} for n in opts.num_workers], 'images/s'),
+        'wrn': (TASK1, bench_wrn,
+                [{'model': m, 'pass': p} for m in opts.models
+                 for p in ('forward', 'forward_backward')], 'images/s'),
+        'vat': (TASK2, bench_vat, [{'vat_iter': k} for k in opts.vat_iters], 'images/s'),
+        'pseudo_label': (TASK1, bench_pseudo_label, [{'threshold': 0.95}], 'images/s'),
+        'fixmatch': (TASK3, bench_fixmatch, [{'mu': mu} for mu in opts.mu], 'images/s'),
+        'evaluate': (TASK1, bench_evaluate,
+                     [{'eval_data': d} for d in ('loader', 'memory')], 'images/s'),
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_path, text=True,
+                                capture_output=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import torchvision
+    cpus = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count())
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'torchvision': torchvision.__version__,
+        'numpy': np.__version__,
+        'cpus': len(cpus),
+        'torch_threads': torch.get_num_threads(),
+        'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+        'commit': commit,
+        'argv': sys.argv[1:],
+    }
+
+
+def run(opts):
+    cases = benchmark_cases(opts)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    print('{:<14} {:<48} {:>14} {:>12}'.format('case', 'params', 'throughput', 'ms/step'))
+    for name in opts.cases:
+        task, function, grid, unit = cases[name]
+        for params in grid:
+            times, items = run_case(context, task, function, params, opts)
+            median = float(np.median(times))
+            result = {
+                'name': name,
+                'task': task,
+                'params': params,
+                'unit': unit,
+                'value': items / median,
+                'higher_is_better': True,
+                'median_ms': 1000 * median,
+                'min_ms': 1000 * min(times),
+                'mean_ms': 1000 * float(np.mean(times)),
+                'steps': len(times),
+                'items_per_step': items,
+            }
+            results.append(result)
+            print('{:<14} {:<48} {:>14.1f} {:>12.2f}'.format(
+                name, json.dumps(params), result['value'], result['median_ms']))
+
+    report = {'environment': environment(), 'results': results}
+    with open(opts.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to {}'.format(opts.out))
+    if opts.baseline is not None:
+        return compare(opts.baseline, opts.out, opts.tolerance)
+    return 0
+
+
+def _key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(baseline_path, current_path, tolerance):
+    '''
+    returns : (int) 1 when any result is more than `tolerance` (a fraction)
+              worse than the baseline, else 0
+    '''
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+    for key in ('host', 'torch', 'cpus', 'cuda'):
+        if baseline['environment'].get(key) != current['environment'].get(key):
+            print('Warning: {} differs, baseline {} vs current {}'.format(
+                key, baseline['environment'].get(key), current['environment'].get(key)))
+
+    base_results = {_key(r): r for r in baseline['results']}
+    regressions = 0
+    print('{:<14} {:<48} {:>12} {:>12} {:>9}'.format('case', 'params', 'baseline', 'current', 'change'))
+    for result in current['results']:
+        base = base_results.pop(_key(result), None)
+        if base is None:
+            print('{:<14} {:<48} {:>12} {:>12.1f}     (new)'.format(
+                result['name'], _key(result)[1], '-', result['value']))
+            continue
+        change = result['value'] / base['value'] - 1
+        if not result['higher_is_better']:
+            change = -change
+        flag = ''
+        if change < -tolerance:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif change > tolerance:
+            flag = 'improved'
+        print('{:<14} {:<48} {:>12.1f} {:>12.1f} {:>+8.1f}% {}'.format(
+            result['name'], _key(result)[1], base['value'], result['value'], 100 * change, flag))
+    for name, params in base_results:
+        print('{:<14} {:<48} missing from the current results'.format(name, params))
+    print('{} regression(s) beyond {:.0f}%'.format(regressions, 100 * tolerance))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the data, model, loss \
+                                        and evaluation hot paths of the three tasks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks and write the results as JSON')
+    run_parser.add_argument('--out', default='benchmark.json', type=str,
+                            help='JSON file of the results and the environment')
+    run_parser.add_argument('--cases', nargs='+', default=['getitem', 'loader', 'wrn', 'vat',
+                                                           'pseudo_label', 'fixmatch', 'evaluate'],
+                            choices=['getitem', 'loader', 'wrn', 'vat',
+                                     'pseudo_label', 'fixmatch', 'evaluate'],
+                            help='benchmarks to run')
+    run_parser.add_argument("--datapath", default="./data/", type=str,
+                            help="root of the synthetic dataset, it is generated once under "
+                                 "<datapath>/synthetic-N, no download")
+    run_parser.add_argument('--synthetic', default=50000, type=int,
+                            help='number of synthetic training images')
+    run_parser.add_argument('--num-labeled', type=int, default=4000,
+                            help='Total number of labeled samples')
+    run_parser.add_argument('--batch', default=64, type=int,
+                            help='batch size of every case (labeled batch for fixmatch)')
+    run_parser.add_argument('--num-workers', type=int, nargs='+', default=[0, 2, 4],
+                            help='DataLoader worker counts of the loader case')
+    run_parser.add_argument('--models', nargs='+', default=['28-2', '16-8', '28-10'],
+                            help='WideResNet depth-width configurations of the wrn case')
+    run_parser.add_argument('--model', default='28-2', type=str,
+                            help='WideResNet depth-width of the vat, fixmatch and evaluate cases')
+    run_parser.add_argument('--vat-iters', type=int, nargs='+', default=[1, 2, 4],
+                            help='power iteration counts of the vat case')
+    run_parser.add_argument('--mu', type=int, nargs='+', default=[1, 7],
+                            help='unlabeled to labeled ratios of the fixmatch case')
+    run_parser.add_argument('--eval-samples', default=2000, type=int,
+                            help='test images per evaluate_model pass')
+    run_parser.add_argument('--eval-workers', default=0, type=int,
+                            help='DataLoader workers of the evaluate case')
+    run_parser.add_argument('--steps', default=10, type=int,
+                            help='timed steps per configuration')
+    run_parser.add_argument('--warmup', default=2, type=int,
+                            help='untimed steps before timing')
+    run_parser.add_argument('--baseline', default=None, type=str,
+                            help='compare the new results against this JSON file')
+    run_parser.add_argument('--tolerance', default=0.1, type=float,
+                            help='slowdown (fraction) flagged as a regression')
+
+    compare_parser = commands.add_parser('compare', help='flag regressions against a baseline')
+    compare_parser.add_argument('baseline', type=str, help='JSON file of the baseline run')
+    compare_parser.add_argument('current', type=str, help='JSON file of the run to check')
+    compare_parser.add_argument('--tolerance', default=0.1, type=float,
+                                help='slowdown (fraction) flagged as a regression')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        sys.exit(run(args))
+    sys.exit(compare(args.baseline, args.current, args.tolerance))